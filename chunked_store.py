@@ -0,0 +1,199 @@
+# Compressed, chunked arrays in a directory, read a slice at a time.
+#
+# A store is a directory with an index, index.json (the datasets' shape,
+# dtype and chunk shape, and free metadata such as N or the glob patterns of
+# a compile), and one subdirectory per dataset holding its chunks, each the
+# zlib compressed C order bytes of one block of the array, named by its
+# position in the chunk grid ('0.3.0'), like zarr. Reading data[i] or
+# data[:, :, t0:t1] only decompresses the chunks the slice touches, so a
+# plot of one map does not load the whole compile.
+
+import itertools
+import json
+import os
+import shutil
+import zlib
+
+import numpy as np
+
+INDEX = 'index.json'
+
+# aim for chunks of about this many bytes
+_CHUNK_BYTES = 1 << 20
+
+def default_chunks(shape, itemsize):
+    """One chunk per index of the leading axes (e.g. data index) and, over
+    the last two (neurons x time), all the rows and as many columns as fit
+    in about a megabyte."""
+    shape = tuple(shape)
+    if not shape:
+        return ()
+    if len(shape) == 1:
+        return (max(1, min(shape[0], _CHUNK_BYTES // itemsize)),)
+    rows = max(1, shape[-2])
+    cols = max(1, min(shape[-1], _CHUNK_BYTES // (rows * itemsize)))
+    return (1,) * (len(shape) - 2) + (rows, cols)
+
+def _grid(shape, chunks):
+    return tuple(-(-n // c) if n else 0 for n, c in zip(shape, chunks))
+
+def _chunk_name(position):
+    return '.'.join(str(x) for x in position) if position else '0'
+
+def write(path, datasets, meta=None, chunks=None, level=6):
+    """Write datasets (name -> array) and meta (anything JSON can hold) to
+    the store directory path, replacing it if it exists. chunks maps
+    dataset names to chunk shapes (default_chunks otherwise). The store is
+    written aside and swapped in, so readers never see half of it."""
+    chunks = chunks or {}
+    datasets = dict((name, np.asarray(data)) for name, data in datasets.items())
+    specs = dict((name, (data.shape, data.dtype, chunks.get(name))) for name, data in datasets.items())
+    writer = StoreWriter(path, specs, meta, level)
+    for name, data in sorted(datasets.items()):
+        writer.write(name, (0,) * data.ndim, data)
+    writer.close()
+
+class StoreWriter(object):
+    """A store written a block at a time, e.g. by several processes.
+
+    datasets maps names to (shape, dtype, chunks), chunks None for
+    default_chunks. write(name, start, block) stores the chunks block covers;
+    start has to be on the chunk grid and block made of whole chunks (or
+    reach the end of the axis). Chunks are separate files, so processes can
+    write different blocks of the same writer at once. close swaps the store
+    in at path once everything is written.
+    """
+
+    def __init__(self, path, datasets, meta=None, level=6):
+        self.path = path
+        self.tmp = path + '.tmp'
+        self.level = level
+        if os.path.isdir(self.tmp):
+            shutil.rmtree(self.tmp)
+        os.makedirs(self.tmp)
+        self.entries = {}
+        for name, (shape, dtype, chunks) in sorted(datasets.items()):
+            shape = tuple(int(n) for n in shape)
+            dtype = np.dtype(dtype)
+            chunks = tuple(chunks) if chunks else default_chunks(shape, dtype.itemsize)
+            if len(chunks) != len(shape):
+                raise ValueError('chunks %s of %s do not match its %d dimensions' % (chunks, name, len(shape)))
+            self.entries[name] = {'shape': list(shape), 'dtype': dtype.str, 'chunks': list(chunks), 'compressor': 'zlib'}
+            os.makedirs(os.path.join(self.tmp, name))
+        with open(os.path.join(self.tmp, INDEX), 'w') as f:
+            json.dump({'datasets': self.entries, 'meta': meta}, f, sort_keys=True, indent=1)
+
+    def write(self, name, start, block):
+        entry = self.entries[name]
+        shape, chunks = entry['shape'], entry['chunks']
+        block = np.asarray(block, dtype=entry['dtype'])
+        for s, n, c, b in zip(start, shape, chunks, block.shape):
+            if s % c or (b % c and s + b != n):
+                raise ValueError('block of %s at %s is not made of whole chunks %s' % (name, tuple(start), tuple(chunks)))
+        first = [s // c for s, c in zip(start, chunks)]
+        for offset in itertools.product(*[range(n) for n in _grid(block.shape, chunks)]):
+            part = block[tuple(slice(o * c, (o + 1) * c) for o, c in zip(offset, chunks))]
+            position = tuple(f + o for f, o in zip(first, offset))
+            with open(os.path.join(self.tmp, name, _chunk_name(position)), 'wb') as f:
+                f.write(zlib.compress(np.ascontiguousarray(part).tobytes(), self.level))
+
+    def dataset(self, name):
+        """The dataset name as written so far, before close."""
+        return Dataset(os.path.join(self.tmp, name), self.entries[name])
+
+    def close(self):
+        if os.path.isdir(self.path):
+            old = self.path + '.old'
+            os.rename(self.path, old)
+            os.rename(self.tmp, self.path)
+            shutil.rmtree(old)
+        else:
+            os.rename(self.tmp, self.path)
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, INDEX))
+
+class ChunkedStore(object):
+    """The store directory path: store[name] is a lazy Dataset, names
+    lists them and meta is what write was given."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX)) as f:
+            index = json.load(f)
+        self.entries = index['datasets']
+        self.names = sorted(self.entries)
+        self.meta = index['meta']
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __getitem__(self, name):
+        return Dataset(os.path.join(self.path, name), self.entries[name])
+
+class Dataset(object):
+    """One array of a ChunkedStore, read on indexing.
+
+    data[key] takes integers and slices (any step) per axis and returns a
+    numpy array; iterating goes over the first axis, one data[i] at a time,
+    and np.asarray(data) reads all of it.
+    """
+
+    def __init__(self, path, entry):
+        self.path = path
+        self.shape = tuple(entry['shape'])
+        self.dtype = np.dtype(entry['dtype'])
+        self.chunks = tuple(entry['chunks'])
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.asarray(self[tuple(slice(None) for _ in self.shape)])
+        return data if dtype is None else data.astype(dtype)
+
+    def _chunk(self, position):
+        shape = tuple(min(c, n - p * c) for p, c, n in zip(position, self.chunks, self.shape))
+        with open(os.path.join(self.path, _chunk_name(position)), 'rb') as f:
+            return np.frombuffer(zlib.decompress(f.read()), dtype=self.dtype).reshape(shape)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > self.ndim:
+            raise IndexError('%d indices for %d dimensions' % (len(key), self.ndim))
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        # entries wanted along each axis, and the box of them to read
+        wanted = []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, slice):
+                wanted.append(np.arange(n)[k])
+            else:
+                k = int(k)
+                if not -n <= k < n:
+                    raise IndexError('index %d out of range for %d entries' % (k, n))
+                wanted.append(np.array([k % n]))
+        if any(len(w) == 0 for w in wanted):
+            box = np.zeros(tuple(len(w) for w in wanted), dtype=self.dtype)
+        else:
+            lo = [int(w.min()) for w in wanted]
+            hi = [int(w.max()) + 1 for w in wanted]
+            box = np.empty(tuple(b - a for a, b in zip(lo, hi)), dtype=self.dtype)
+            ranges = [range(a // c, -(-b // c)) for a, b, c in zip(lo, hi, self.chunks)]
+            for position in itertools.product(*ranges):
+                chunk = self._chunk(position)
+                start = [p * c for p, c in zip(position, self.chunks)]
+                # overlap of the chunk and the box, in chunk and box coordinates
+                src = tuple(slice(max(a, s) - s, min(b, s + n) - s) for a, b, s, n in zip(lo, hi, start, chunk.shape))
+                dst = tuple(slice(max(a, s) - a, min(b, s + n) - a) for a, b, s, n in zip(lo, hi, start, chunk.shape))
+                box[dst] = chunk[src]
+            if any(len(w) != b - a or (len(w) > 1 and w[1] < w[0]) for w, a, b in zip(wanted, lo, hi)):
+                box = box[np.ix_(*[w - a for w, a in zip(wanted, lo)])]
+        # integers drop their axis
+        return box[tuple(0 if not isinstance(k, slice) else slice(None) for k in key)]
@@ -0,0 +1,93 @@
+# Inter-spike intervals and burst labels of all the neurons of a detector.
+#
+# A spike detector's (senders, times) events are grouped by neuron with one
+# stable sort, CSR style: neuron i's spikes are times[offsets[i]:offsets[i +
+# 1]], in time order. The intervals are then a single np.diff over all of
+# them, dropping the ones between two neurons, and the burst labels a
+# threshold mask on those, so nothing loops over neurons or spikes.
+
+import numpy as np
+
+import spike_raster
+
+# spike / bin labels, as in nsdm_analyze_isi
+SILENT, REGULAR, BURSTING = 0, 1, 2
+
+def spike_trains(senders, times, gids=None):
+    """The spikes of GIDs gids[0] to gids[1] (inclusive; the smallest and
+    largest sender by default) grouped by neuron.
+
+    Returns a dict with 'first_gid', 'times' (neuron by neuron, each in time
+    order), 'offsets' (neuron i, GID first_gid + i, fired times[offsets[i]:
+    offsets[i + 1]]) and 'order' (times is the input times[order]). Spikes
+    of other GIDs are left out.
+    """
+    senders = np.asarray(senders, dtype=np.int64).ravel()
+    times = np.asarray(times, dtype=np.float64).ravel()
+    if senders.shape != times.shape:
+        raise ValueError('%d senders for %d times' % (len(senders), len(times)))
+    if gids is None:
+        gids = (senders.min(), senders.max()) if senders.size else (0, -1)
+    first, last = int(gids[0]), int(gids[1])
+    nrows = max(last - first + 1, 0)
+
+    order = np.flatnonzero((senders >= first) & (senders <= last))
+    # detectors mostly write in time order: only sort by time when they don't
+    # (spikes of a neuron at the same time are the same spike twice, so their
+    # order does not matter)
+    if np.any(np.diff(times[order]) < 0):
+        order = order[np.argsort(times[order])]
+    # the stable sort by neuron keeps each one's spikes in time order (a radix
+    # sort with up to 65536 neurons)
+    rows = (senders[order] - first).astype(np.uint16 if nrows <= 1 << 16 else np.int64)
+    order = order[np.argsort(rows, kind='stable')]
+    offsets = np.zeros(nrows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=nrows), out=offsets[1:])
+    return {'first_gid': first, 'times': times[order], 'offsets': offsets, 'order': order}
+
+def analyze(senders, times, gids=None, burst_isi=3.):
+    """Spike trains (spike_trains) with their ISIs and burst labels.
+
+    Adds to spike_trains' dict 'isi' (neuron by neuron, the intervals
+    between its consecutive spikes), 'isi_offsets' (neuron i's are
+    isi[isi_offsets[i]:isi_offsets[i + 1]], one fewer than its spikes) and
+    'labels' (uint8, one per spike of times: BURSTING when an interval to
+    the neuron's previous or next spike is below burst_isi ms, REGULAR
+    otherwise).
+    """
+    trains = spike_trains(senders, times, gids)
+    times, offsets = trains['times'], trains['offsets']
+
+    steps = np.diff(times)
+    # every step but those from one neuron's last spike to the next one's first
+    within = np.ones(len(steps), dtype=bool)
+    ends = offsets[1:-1] - 1
+    within[ends[(ends >= 0) & (ends < len(steps))]] = False
+    counts = np.maximum(np.diff(offsets) - 1, 0)
+    isi_offsets = np.zeros(len(offsets), dtype=np.int64)
+    np.cumsum(counts, out=isi_offsets[1:])
+
+    labels = np.full(len(times), REGULAR, dtype=np.uint8)
+    short = within & (steps < burst_isi)
+    # both spikes of a short interval are bursting
+    labels[:-1][short] = BURSTING
+    labels[1:][short] = BURSTING
+
+    trains.update(isi=steps[within], isi_offsets=isi_offsets, labels=labels)
+    return trains
+
+def state_raster(analysis, window, bin_width=1.):
+    """Neurons x bins (spike_raster.bin_index over window) of the labels of
+    analyze: SILENT where a neuron does not fire, else its spike's label,
+    BURSTING if any of its spikes in the bin is."""
+    times, offsets, labels = analysis['times'], analysis['offsets'], analysis['labels']
+    nrows = len(offsets) - 1
+    ncols = max(spike_raster.n_bins(window, bin_width), 0)
+    rows = np.repeat(np.arange(nrows), np.diff(offsets))
+    cols = spike_raster.bin_index(times, window, bin_width)
+    keep = (cols >= 0) & (cols < ncols) & (times < window[1])
+    states = np.zeros((nrows, ncols), dtype=np.uint8)
+    states[rows[keep], cols[keep]] = REGULAR
+    bursting = keep & (labels == BURSTING)
+    states[rows[bursting], cols[bursting]] = BURSTING
+    return states
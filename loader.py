@@ -0,0 +1,47 @@
+# Loading many pickles while the previous ones are being used.
+#
+# On NFS most of a compile is spent in open + pickle.load, one file after
+# the other. prefetch keeps the next few files loading in a pool while the
+# caller works on the current one, and hands them back in order. At most
+# ahead files are loaded or waiting at any time, so a slow consumer holds
+# the pool back instead of piling up rasters in memory.
+
+import collections
+import itertools
+import pickle
+
+from concurrent import futures
+
+def load(path):
+    """The object pickled in path."""
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def prefetch(items, load=load, ahead=4, workers=None, processes=False):
+    """Yield (item, load(item)) for items (paths by default), in order,
+    with up to ahead of them being loaded by workers (default ahead)
+    threads, or processes with processes=True (load then has to be a
+    module level function). Threads suit file I/O, processes suit loads
+    that spend their time unpickling. An error in load is raised when its
+    item is reached; leaving the loop early cancels the loads not started.
+    """
+    if ahead < 1:
+        raise ValueError('ahead has to be at least 1, got %r' % (ahead,))
+    items = iter(items)
+    pool = (futures.ProcessPoolExecutor if processes else futures.ThreadPoolExecutor)(workers or ahead)
+    window = collections.deque()
+    try:
+        for item in itertools.islice(items, ahead):
+            window.append((item, pool.submit(load, item)))
+        while window:
+            item, loading = window.popleft()
+            data = loading.result()
+            # refill before handing data over, so the pool works meanwhile
+            for next_item in itertools.islice(items, 1):
+                window.append((next_item, pool.submit(load, next_item)))
+            yield item, data
+            del data
+    finally:
+        for _, loading in window:
+            loading.cancel()
+        pool.shutdown(wait=True)
@@ -7,10 +7,10 @@ if __name__ == '__main__' and __package__ is None:
 import os
 import numpy as np
 import glob
-import pickle
-from pypci import pci
-import time
-from scipy import stats
+import loader
+import pci
+import raster_store
+import tiled_compile
 
 import matplotlib
 matplotlib.use("Agg")
@@ -32,114 +32,85 @@ dir_to_load = '/sim_*_lambda_dg_2.00*'
 files_to_load = '/spikes_Vp*L4*.pickle'
 #files_to_load = '/spikes_Retina*.pickle'
 
-all_folders = glob.glob(root_dir + dir_to_load )
+all_folders = sorted(glob.glob(root_dir + dir_to_load ))
 
 # assume all simulations have the same number of files
 first_folder = all_folders[0]
-all_files = glob.glob(first_folder + files_to_load )
+all_files = sorted(glob.glob(first_folder + files_to_load ))
 nfiles = len(all_files)
 nfolders = len(all_folders)
 
-with open(all_files[0], 'r') as f:
-    data = pickle.load(f)
-
-sd = data['senders']
-ts = data['times']
-
-ts = np.round(ts*10).astype('int')
-
-mint = min(ts)
-maxt = max(ts)
-mindiff = min(np.diff(np.unique(ts)))
-ntime = len(range(mint, maxt, mindiff)) + 1
-
-#neurons = 1600
-#nneurons = max(sd) - min(sd) + 1
-# some times do not have all the neurons active in the session, so round up
-nneurons = np.int64(np.ceil((max(sd) - min(sd) + 1)/100.)*100.)
+# Rasters are binned by spike_raster.bin_spikes: one row per GID of the
+# population's (first GID, last GID) in the folder's gids.pickle (saved by
+# the simulation scripts, keyed like the spikes_<population>.pickle files), or
+# of gid_range for every file when set, and bin_width ms bins over
+# time_window, whichever neuron or time happens to fire first.
+bin_width = 1.
+time_window = (0., 40.)
+gid_range = None
+#gid_range = (1, 1600)
+
+def population_gids(folder, next_file):
+    if gid_range is not None:
+        return gid_range
+    population = os.path.basename(next_file)[len('spikes_'):-len('.pickle')]
+    return loader.load(os.path.join(folder, 'gids.pickle'))[population]
 
 downsample_neuron = 0
 #downsample_neuron = 4
 #downsample_neuron = 16
-#nneurons = np.int64(nneurons/downsample_neuron)
-
-# TODO assume they all have the same size!
-
-ntime = 40
-
-_all_sim = np.zeros((nfolders,nfiles,nneurons,ntime))
-
-for folder_idx, this_folder in enumerate(all_folders):
-
-    all_files = glob.glob(this_folder + files_to_load)
-
-    # Set up formatting for the movie files
-    #Writer = animation.writers['ffmpeg']
-    #writer = Writer(fps=15, metadata=dict(artist='Me'), bitrate=1800)
-
-
-    for files_idx, next_file in enumerate(all_files):
-
-        print ('Loading ' + next_file)
-        with open(next_file, 'r') as f:
-            data = pickle.load(f)
-
-        sd = data['senders']
-        ts = data['times']
-
-        #plt.plot(sd)
-        #plt.show()
 
-        #ts = np.round(ts*10).astype('int')
-        ts = np.round(ts).astype('int')
+# Set up formatting for the movie files
+#Writer = animation.writers['ffmpeg']
+#writer = Writer(fps=15, metadata=dict(artist='Me'), bitrate=1800)
 
-        mint = min(ts)
-        maxt = max(ts)
-        mindiff = min(np.diff(np.unique(ts)))
-        #ntime = len(range(mint, maxt, mindiff)) + 1
-
-        #ntime = 40
-        # ntime = 400
-
-        neurons = 1600
-        #nneurons = max(sd) - min(sd) + 1
-        # some times do not have all the neurons active in the session, so round up
-        #nneurons = np.int64(np.ceil((max(sd) - min(sd) + 1)/100.)*100.)
-        #nneurons = np.int64(np.ceil((max(sd) - min(sd) + 1)/10.)*10.)
-
-        this_neurons = np.zeros((nneurons, ntime))
-        this_neurons[sd-min(sd), ts-mint] = 1.
-
-        # TODO can use this to smooth
-        #smoop = 10 # in samples!
-        #this_neurons = 1 * (np.array([np.sum(this_neurons[:,t:t+smoop], 1) for t in range(0, ntime-smoop, smoop)]).T > 0)
-
-        if downsample_neuron > 0:
-            downsample = downsample_neuron
-            this_data = this_neurons
-            this_neurons = np.array([1 * (np.any(this_data[x:x + downsample-1, :], 0)) for x in range(0, this_data.shape[0], downsample)])
-
-        _all_sim[folder_idx,files_idx,:,:] = this_neurons
-
-        #_all_sim = zeros((nfiles,) + (nfolders,) + this_neurons.shape)
-
-results = dict()
-
-results['N'] = _all_sim.shape[0]
-
-results['mean'] = np.mean(_all_sim, 0)
-
-neural_std = np.std(_all_sim,0)
-neural_std_all = np.unique(neural_std.flatten())
-neural_std[neural_std == .0] = neural_std_all[1]
-results['z'] = results['mean']/neural_std
-results['t'] = stats.ttest_1samp(_all_sim, .5, axis=0).statistic
-results['any'] = np.any(_all_sim, 0)
-#np.mean((_all_sim - results['mean'])/(np.std(_all_sim,0)/np.sqrt(_all_sim.shape[0])),0)
-
-output_file = ('results_D%d' % downsample_neuron) + dir_to_load.replace('*', '').replace('/', '') + '_' + files_to_load.replace('*', '').replace('/', '')
-
-with open(root_dir + '/' + output_file, 'w') as f:
-    pickle.dump(results, f)
-
-print('Done compiling!')
\ No newline at end of file
+# The statistics across runs are compiled by tiled_compile, a tile of the
+# neurons x time plane of one file at a time: each tile streams that file of
+# every simulation (read prefetch_files ahead) into its own mean, variance
+# and OR, and is written to the .chunks store when done. memory_budget
+# (bytes) bounds the num_cores tiles accumulated at once; None compiles each
+# file in one tile.
+# TODO assume they all have the same size!
+memory_budget = None
+#memory_budget = 4 * 1024 ** 3
+num_cores = 1
+#num_cores = -1 # all cores
+
+# files read ahead (loader.prefetch) while the current one is binned
+prefetch_files = 8
+
+# every simulation's files in the order of the first folder's, which gids follows
+runs = [[os.path.join(this_folder, os.path.basename(next_file)) for next_file in all_files]
+        for this_folder in all_folders]
+gids = [population_gids(first_folder, next_file) for next_file in all_files]
+
+output_file = ('results_D%d' % downsample_neuron) + dir_to_load.replace('*', '').replace('/', '') + '_' + files_to_load.replace('*', '').replace('/', '').replace('.pickle', '')
+
+# the compile workers import this script again under the spawn start method,
+# so only the main process compiles
+if __name__ == '__main__':
+
+    # Named datasets (data index x neurons x time) in compressed chunks of one
+    # data index and a tile (chunked_store), so readers fetch a single map or
+    # time slice; and how they were compiled.
+    settings = {'root_dir': root_dir, 'dir_to_load': dir_to_load, 'files_to_load': files_to_load,
+                'folders': all_folders, 'downsample_neuron': downsample_neuron, 'bin_width': bin_width,
+                'time_window': time_window, 'gid_range': gid_range}
+    store = tiled_compile.compile_runs(runs, gids, time_window, bin_width, root_dir + '/' + output_file + '.chunks',
+                                       memory_budget=memory_budget, n_jobs=num_cores,
+                                       downsample_neuron=downsample_neuron, meta=settings, log=print,
+                                       ahead=prefetch_files)
+
+    # the same rasters for the PCI workers, which map them and read only the
+    # slices they need (raster_store); one 2D raster per file, read back one file
+    # at a time: 'any_<file>' binary and packed (one bit per entry), and
+    # 'mean_<file>', 'z_<file>' and 't_<file>' when the statistics fit in memory
+    # (memory_budget None)
+    rasters = []
+    if memory_budget is None:
+        rasters += [('%s_%d' % (name, files_idx), store[name][files_idx])
+                    for name in ('mean', 'z', 't') for files_idx in range(nfiles)]
+    rasters += [('any_%d' % files_idx, pci.PackedRaster.pack(store['any'][files_idx])) for files_idx in range(nfiles)]
+    raster_store.write(root_dir + '/' + output_file + '.rasters', rasters, meta=store.meta)
+
+    print('Done compiling!')
@@ -54,6 +54,16 @@ import csv
 #f_idx = open('idx.csv', 'w')
 #writer_idx = csv.writer(f_idx)
 
+# Live PCI
+# ========
+#
+# Name of a detector (e.g. 'Vp_v L4pyr') whose PCI is followed while the
+# network is simulated in sim_interval steps, or None to simulate in one go.
+# The run stops early once that PCI goes above live_pci_stop_above. Following
+# the PCI imports pci, which needs Python 3 and NumPy 1.17 or later.
+live_pci_detector = None
+live_pci_stop_above = None
+
 # Configurable Parameters
 # =======================
 
@@ -875,6 +885,7 @@ for lambda_dg in lambdas:
 
         # create the spike detectors
         detectors = {}
+        detector_gids = {}
         for name, population, model in [('Vp_v L4pyr', Vp_v, 'L4pyr'),
                                         ('Vp_h L4pyr', Vp_h, 'L4pyr'),
                                         ('Vp_v L23pyr', Vp_v, 'L23pyr'),
@@ -887,6 +898,7 @@ for lambda_dg in lambdas:
             tgts = [nd for nd in nest.GetLeaves(population)[0]
                     if nest.GetStatus([nd], 'model')[0] == model]
             detectors[name] = (nest.Create('spike_detector', params={"withgid": True, "withtime": True}), loc)
+            detector_gids[name] = (min(tgts), max(tgts))
             print(name + ' : %d' % max(tgts))
 
             # TODO For some reason, some retina nodes have different synapse types. Connect one by one for now
@@ -899,9 +911,37 @@ for lambda_dg in lambdas:
             else:
                 nest.Connect(tgts, detectors[name][0])
 
+        # population -> (first GID, last GID), saved with the spikes for pci.pci_regions
+        population_gids = dict(detector_gids)
+        for name, layer in [('Retina_layer', retina), ('Tp_layer', Tp), ('Rp_layer', Rp),
+                            ('Vp_horizontal', Vp_h), ('Vp_vertical', Vp_v)]:
+            leaves = nest.GetLeaves(layer)[0]
+            population_gids[name] = (min(leaves), max(leaves))
+
         #TODO check difference with respect to running each step at a time
         # and run the simulation
-        nest.Simulate(Params['simtime'])
+        if live_pci_detector is None:
+            nest.Simulate(Params['simtime'])
+        else:
+            # run in sim_interval steps, one raster column per step, and follow
+            # the PCI of one detector as the columns come in
+            rec = detectors[live_pci_detector][0]
+            first_gid, last_gid = detector_gids[live_pci_detector]
+            # pci needs Python 3 and NumPy 1.17 or later, so it is only imported here
+            import pci
+            stream = pci.PCIStream()
+            seen = 0
+            for step in range(int(round(Params['simtime'] / Params['sim_interval']))):
+                nest.Simulate(Params['sim_interval'])
+                senders = nest.GetStatus(rec, 'events')[0]['senders'][seen:]
+                seen += len(senders)
+                column = np.zeros(last_gid - first_gid + 1)
+                column[senders - first_gid] = 1
+                stream.push(column)
+                print('PCI of %s at %.1f ms : %d' % (live_pci_detector, (step + 1) * Params['sim_interval'], stream.complexity))
+                if live_pci_stop_above is not None and stream.complexity > live_pci_stop_above:
+                    print('PCI above %d, stopping early' % live_pci_stop_above)
+                    break
 
         data_folder = './data/' + folder_name + 'detectors'
         if not os.path.isdir(data_folder):
@@ -936,6 +976,9 @@ for lambda_dg in lambdas:
 
             plt.close()
 
+        with open(data_folder + '/gids.pickle', 'w') as f:
+            pickle.dump(population_gids, f)
+
         # just for some information at the end
         #print(nest.GetKernelStatus())
 
@@ -5,14 +5,17 @@ if __name__ == '__main__' and __package__ is None:
     sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
 import numpy as np
+import fnmatch
 import glob
 import pickle
 
-# git clone https://github.com/noreun/pypci
-from pypci import pci
+import loader
+import pci
+import pci_jobs
+#import pooling # for the downsampling examples in loadInput
+import raster_store
 
 import time
-from joblib import Parallel, delayed
 
 #downsample_neuron = 0
 #downsample_neuron = 4
@@ -22,6 +25,12 @@ downsample_neuron = 1000
 #downsample_time = 4
 downsample_time = 100
 
+# PCI at several resolutions, all levels of a file computed by one worker from
+# one read (pci_jobs.run), one table per file in the results instead of a
+# single value. None only does the full resolution.
+#pyramid_factors = ([1, 4, 16, downsample_neuron], [1, 4, downsample_time])
+pyramid_factors = None
+
 
 #root_dir = '/home/leonardo/projects/nsdm/data'
 root_dir = '/home/leonardo/projects/nsdm/data/from_allen'
@@ -29,28 +38,62 @@ root_dir = '/home/leonardo/projects/nsdm/data/from_allen'
 files_to_load = '/mov_2_scrbl_normal_*.pickle'
 #files_to_load = '/z_*_Vp*.pickle'
 #files_to_load = '/any_*_Vp*.pickle'
+# raster stores (raster_store.py, e.g. from the compile script or converted
+# pickles) are mapped by the workers, which then read only their slice
+#files_to_load = '/results_*.rasters'
 
 all_files = glob.glob(root_dir + files_to_load)
 
-# load epochs and calculate
-def processInput(idx, next_file):
-
-    t = time.time()
-
-    print ('Calculating PCI for' + next_file)
-    with open(next_file, 'r') as ft:
-        data = pickle.load(ft)
+# rasters of the stores in all_files to run, by name (the compile script
+# stores 'any_<file>', 'mean_<file>', 'z_<file>' and 't_<file>')
+store_rasters = 'any_*'
+#store_rasters = 'z_*'
+#store_rasters = '*'
+
+# (file, raster name in the store or None for a pickle)
+all_rasters = []
+for next_file in all_files:
+    if raster_store.is_store(next_file):
+        names = raster_store.RasterStore(next_file).names
+        all_rasters += [(next_file, name) for name in fnmatch.filter(names, store_rasters)]
+    else:
+        all_rasters.append((next_file, None))
+labels = [next_file if name is None else next_file + ':' + name for next_file, name in all_rasters]
+
+# PCI of every population and of the unions of populations listed in unions
+# (pci.pci_regions), one table per file, from the population -> (first GID,
+# last GID) map the simulation saves in gids.pickle; row 0 of the data is GID
+# first_gid. None only does the neurons selected in loadInput.
+#regions = pickle.load(open(root_dir + '/sim_1_detectors/gids.pickle', 'r'))
+#regions = {'biophysical': (1, 10000), 'LIF': (10001, 20000)}
+regions = None
+first_gid = 1
+#unions = [('biophysical', 'LIF')]
+#unions = [('Vp_h L4pyr', 'Vp_v L4pyr')]
+unions = []
+
+# Bytes the PCI workers may hold at once, by the cost model fitted on the
+# timings in the cache (pci_jobs.CostModel); big rasters then wait for room
+# instead of all loading together. None only limits the number of workers.
+#memory_cap = 32 * 1024 ** 3
+memory_cap = None
+
+# load epochs
+def loadInput(idx, next_file, name=None):
+
+    print ('Loading ' + next_file)
+    if name is not None:
+        data = raster_store.load(next_file, name)
+    else:
+        data = loader.load(next_file)
 
     data_to_pci = data
 
     #data_to_pci = data[::10,::10]
-    #data_to_pci = np.array([1 * (np.any(data[x:x + 9, :], 0)) for x in range(0, data.shape[0], 10)])
+    #data_to_pci = pooling.pool(data, 10, reduce='any')
 
-    # if downsample_neuron > 0:
-    #     data = np.array([1 * (np.mean(data[x:x + downsample_neuron-1, :], 0) > .5) for x in range(0, data.shape[0], downsample_neuron)])
-
-    # if downsample_time > 0:
-    #    data = np.array([1 * (np.mean(data[:, x:x + downsample_time-1], 0) > .5) for x in range(0, data.shape[1], downsample_time)])
+    # if downsample_neuron > 0 or downsample_time > 0:
+    #     data = pooling.pool(data, max(downsample_neuron, 1), max(downsample_time, 1), reduce='majority')
 
     # quick speed test
     #data_dsampled = data[10000:16000:10,501:]; data_to_pci = data_dsampled; print(data_to_pci.shape)
@@ -59,52 +102,102 @@ def processInput(idx, next_file):
     #print('only calculating LIF Neurons (10000 to 20000) from 500 ms to 3000 ms')
     #data_dsampled = data[10000:20001,500:3000]
 
-    print('only calculating bio-physically realistic neurons (1 to 10000) from 500 ms to 5000 ms')
-    data_dsampled = data[:10000,500:3000]
+    if regions is None:
+        print('only calculating bio-physically realistic neurons (1 to 10000) from 500 ms to 5000 ms')
+        data_dsampled = data[:10000,500:3000]
+    else:
+        print('calculating every region from 500 ms to 5000 ms')
+        data_dsampled = data[:,500:3000]
 
     data_to_pci = data_dsampled
 
-    data_c = pci.calculate(data_to_pci)
+    # binary rasters are kept packed until the PCI workers need them
+    if not isinstance(data_to_pci, pci.PackedRaster) and np.all((data_to_pci == 0) | (data_to_pci == 1)):
+        data_to_pci = pci.PackedRaster.pack(data_to_pci)
 
-    elapsed = time.time() - t
+    return data_to_pci
 
-    log = open(root_dir + '/pci_log.txt', 'a+')
+num_cores = 16
 
-    m = "Complexity of data for %s : %d" % (next_file, data_c)
+def log_job(m):
+    # one line per job as it finishes, with its wall time and peak memory
     print(m)
-    log.write(m+'\n')
+    with open(root_dir + '/pci_log.txt', 'a+') as log:
+        log.write(m + '\n')
 
-    m = "Elapsed time : %.2f s" % elapsed
-    print(m)
-    log.write(m+'\n')
+# the PCI workers import this script again under the spawn start method,
+# so only the main process runs the jobs
+if __name__ == '__main__':
+
+    log = open(root_dir + '/pci_log.txt', 'a+')
 
+    log.write('\n\n')
+    log.write("Start: " + time.strftime("%c"))
+    log.write('\n\n')
     log.close()
-    return data_c
 
-log = open(root_dir + '/pci_log.txt', 'a+')
+    t = time.time()
 
-log.write('\n\n')
-log.write("Start: " + time.strftime("%c"))
-log.write('\n\n')
-log.close()
+    if regions is not None:
+        # the next files load while the regions of the current one are parsed
+        inputs = loader.prefetch(enumerate(all_rasters), lambda item: loadInput(item[0], *item[1]), ahead=2)
+        results = [pci.pci_regions(data, regions, first_gid, unions, n_jobs=num_cores) for _, data in inputs]
+    else:
+        # One job per file and pair of downsampling factors, bio-physically
+        # realistic neurons (1 to 10000) from 500 ms to 3000 ms; the jobs of a
+        # file share one worker and one read. Results are committed to the cache
+        # as they finish, so a relaunch only runs the jobs that are missing (new
+        # or changed files, other slices or factors); those start longest first.
+        factors = pyramid_factors if pyramid_factors is not None else ([1], [1])
+        jobs = [pci_jobs.job(next_file, (0, 10000), (500, 3000), neuron_factor, time_factor, name=name)
+                for next_file, name in all_rasters for neuron_factor in factors[0] for time_factor in factors[1]]
+        cache = pci_jobs.ResultCache(root_dir + '/pci_cache.sqlite')
+        done = pci_jobs.run(jobs, cache, n_jobs=num_cores, log=log_job, memory_cap=memory_cap)
+        cache.close()
+        if pyramid_factors is None:
+            results = [r['pci'] for r in done]
+        else:
+            levels = [{'neuron_factor': j['neuron_factor'], 'time_factor': j['time_factor'], 'pci': r['pci']} for j, r in zip(jobs, done)]
+            per_file = len(factors[0]) * len(factors[1])
+            results = [levels[x:x + per_file] for x in range(0, len(levels), per_file)]
 
-num_cores = 16
-results = Parallel(n_jobs=num_cores, verbose=100)(delayed(processInput)(fileid, next_file) for fileid, next_file in enumerate(all_files))
+    elapsed = time.time() - t
 
-#results = []
-#results.append(processInput(0, all_files[0]))
+    log = open(root_dir + '/pci_log.txt', 'a+')
 
-output_file = 'pci_' + files_to_load.replace('*', '').replace('/', '')
+    for next_file, data_c in zip(labels, results):
+        if regions is not None:
+            m = "Complexity of data for %s :" % next_file
+            for row in data_c:
+                m += "\n  %s (%d neurons) : %d" % (' + '.join(row['regions']), row['rows'], row['pci'])
+        elif pyramid_factors is None:
+            m = "Complexity of data for %s : %d" % (next_file, data_c)
+        else:
+            m = "Complexity of data for %s :" % next_file
+            for level in data_c:
+                m += "\n  neurons / %d, time / %d : %d" % (level['neuron_factor'], level['time_factor'], level['pci'])
+        print(m)
+        log.write(m+'\n')
 
-with open(root_dir + '/' + output_file, 'w') as f:
-    pickle.dump(results, f)
+    m = "Elapsed time : %.2f s" % elapsed
+    print(m)
+    log.write(m+'\n')
 
-print('Done PCI!')
+    log.close()
+
+    #results = []
+    #results.append(pci.pci(loadInput(0, all_files[0])))
+
+    output_file = 'pci_' + files_to_load.replace('*', '').replace('/', '')
 
-log = open(root_dir + '/pci_log.txt', 'a+')
+    with open(root_dir + '/' + output_file, 'w') as f:
+        pickle.dump(results, f)
 
-log.write('\n\n')
-log.write("End: " + time.strftime("%c"))
-log.write('\n\n')
-log.close()
+    print('Done PCI!')
 
+    log = open(root_dir + '/pci_log.txt', 'a+')
+
+    log.write('\n\n')
+    log.write("End: " + time.strftime("%c"))
+    log.write('\n\n')
+    log.close()
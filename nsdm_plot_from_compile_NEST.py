@@ -9,6 +9,8 @@ import numpy as np
 import glob
 import pickle
 from pypci import pci
+import chunked_store
+import screen_render
 import time
 
 import matplotlib
@@ -28,10 +30,13 @@ root_dir = '/home/leonardo/projects/nsdm/hill_tononi_synthesis/data'
 
 #files_to_load = '/spikes_Vp*L4*.pickle'
 #files_to_load = '/results_D16*.pickle'
-files_to_load = '/results_D0*VpL4.pickle'
+# compiled results are chunked stores (chunked_store) of the same datasets as
+# the old pickles, read one data index at a time
+#files_to_load = '/results_D0*VpL4.pickle'
+files_to_load = '/results_D0*VpL4.chunks'
 P = 2
 
-#files_to_load = '/results_D0*Retina.pickle'
+#files_to_load = '/results_D0*Retina.chunks'
 #P = 1
 
 all_files = glob.glob(root_dir + files_to_load)
@@ -41,9 +46,41 @@ Writer = animation.writers['ffmpeg']
 writer = Writer(fps=15, metadata=dict(artist='Me'), bitrate=1800)
 
 
+# Screen animations, one per population and data index (screen_render):
+# 'gif' for an animated GIF, 'png' for a PNG per frame as well, None for
+# none; each neuron drawn as movie_zoom x movie_zoom pixels, and the PNG
+# frames written by render_cores processes.
+movie_frames = 'gif'
+movie_zoom = 8
+render_cores = 1
+
+def save_movie(frames, base, cmap, vmin, vmax):
+    # frames are T x P x D x D screens
+    if movie_frames is None:
+        return
+    for p in range(frames.shape[1]):
+        screen_render.write_gif(frames[:, p], base % (p + 1) + '.gif', cmap, vmin, vmax, zoom=movie_zoom)
+        if movie_frames == 'png':
+            screen_render.write_pngs(frames[:, p], [base % (p + 1) + '_t_%d.png' % t for t in range(len(frames))],
+                                     cmap, vmin, vmax, zoom=movie_zoom, n_jobs=render_cores)
+
+# one figure per kind of plot, redrawn with each data index's image instead of
+# a new figure every time
+dots_figure = plt.figure()
+dots, = dots_figure.gca().plot([], [], 'bs')
+#dots_figure.gca().set_ylim([0,10])
+z_figure = screen_render.ImageFigure(matplotlib.cm.hot, vmin=0)
+cmap = matplotlib.cm.gray
+cmap.set_bad('black',1.)
+z_thresh_figure = screen_render.ImageFigure(cmap)
+z_screen_figure = screen_render.ImageFigure(matplotlib.cm.jet, vmin=0.2, vmax=0.4)
+any_figure = screen_render.ImageFigure(matplotlib.cm.gray, vmin=0, vmax=1)
+mean_figure = screen_render.ImageFigure(matplotlib.cm.gray)
+mean_screen_figure = screen_render.ImageFigure(matplotlib.cm.gray)
+
 for idx, next_file in enumerate(all_files):
 
-    figure_name = path.split(next_file)[-1].replace('.pickle', '')
+    figure_name = path.split(next_file)[-1].replace('.pickle', '').replace('.chunks', '')
     figure_folder = root_dir + '/' + figure_name + '_plot'
     if not os.path.isdir(figure_folder):
         os.makedirs(figure_folder)
@@ -53,82 +90,52 @@ for idx, next_file in enumerate(all_files):
         os.makedirs(movie_folder)
 
     print ('Loading ' + next_file)
-    with open(next_file, 'r') as f:
-        results = pickle.load(f)
+    if chunked_store.is_store(next_file):
+        store = chunked_store.ChunkedStore(next_file)
+        results = dict((name, store[name]) for name in store.names)
+        results['N'] = store.meta['N']
+    else:
+        with open(next_file, 'r') as f:
+            results = pickle.load(f)
 
     #print data.items()
 
+    #thresh = 0.00001
+    #thresh = 1
+    thresh = stats.t.isf(0.05, results['N'])
+
     for data_idx, this_data in enumerate(results['z']):
-        fig = plt.figure()
-        #plt.set_cmap('gray')
 
         this_data = np.absolute(this_data)
-        #thresh = 0.00001
-        #thresh = 1
-        thresh = stats.t.isf(0.05, results['N'])
         this_data[np.isnan(this_data)] = 0
 
-        fig = plt.figure()
-        plt.plot(this_data.flatten(), 'bs')
-#        axes = plt.gca()
-#        axes.set_ylim([0,10])
-        fig.savefig(figure_folder + '/' + figure_name + '_z_dotplot_%d.png' % data_idx )
-        plt.clf()
+        dots.set_data(np.arange(this_data.size), this_data.flatten())
+        dots.axes.relim()
+        dots.axes.autoscale_view()
+        dots_figure.savefig(figure_folder + '/' + figure_name + '_z_dotplot_%d.png' % data_idx )
 
         #downsample = 20
         #this_data = np.array([1 * (np.any(this_data[x:x + downsample-1, :], 0)) for x in range(0, this_data.shape[0], downsample)])
 
-        plot_data = this_data
-        cmap = matplotlib.cm.hot
-        plt.imshow(plot_data, interpolation='nearest', aspect='auto', cmap=cmap, vmax = 3*thresh, vmin=0)
-        #plt.imshow(this_data, aspect='auto')
-        plt.colorbar()
-        fig.savefig(figure_folder + '/' + figure_name + '_z_not_thresh_%d.png' % data_idx )
-        plt.clf()
-
-        cbaron = False
-        D = np.sqrt(this_data.shape[0]/P)
-        if D%1 == 0.0:
-            D = np.int64(D)
-            #if np.mod(this_data.shape[0],2) == 0:
-            #D = np.int64(np.round(np.sqrt(this_data.shape[0]/P)))
-            N = this_data.shape[0]
-            T = this_data.shape[1]
-            _all_data = np.zeros((T,P,D,D))
+        z_figure.save(this_data, figure_folder + '/' + figure_name + '_z_not_thresh_%d.png' % data_idx, vmax=3*thresh)
+
+        # If the rows are P square grids (D x D neurons each), plot their
+        # screens: T x P x D x D in one reshape
+        if screen_render.grid_size(this_data.shape[0], P) is not None:
+            _all_data = screen_render.screens(this_data, P)
             print('saving figures for animation')
-            for t in range(0,T):
-                for p in range(1,P+1,1):
-                    p1 = (p-1)*N/P
-                    p2 = p1+(N/P)
-                    this_screen = this_data[p1:p2,t].reshape(D,D)
-                    _all_data[t,p-1,:,:] = this_screen
-                    #plt.imshow(this_screen, interpolation='nearest', aspect='auto', cmap=cmap, vmax = 3*thresh, vmin=0)
-                    #if not cbaron:
-                    #    plt.colorbar()
-                    #    cbaron = True
-                    #fig.savefig(movie_folder + '/' + figure_name + '_p_%d_vh_%d_t_%d.png' % (p, data_idx, t) )
-
-            for p in range(1,P+1,1):
-                mean_screen = np.mean(_all_data[:,p-1,:,:],0)
-                cmap = matplotlib.cm.jet
-                plt.clf()
-                plt.imshow(mean_screen, interpolation='nearest', aspect='auto', cmap=cmap, vmax = 0.4, vmin=0.2)
-                plt.colorbar()
-                #plt.imshow(mean_screen, interpolation='nearest', aspect='auto', cmap=cmap, vmax = 3*thresh, vmin=0)
-                fig.savefig(figure_folder + '/' + figure_name + '_screen_z_p_%d_vh_%d.png' % (p, data_idx) )
+            save_movie(_all_data, movie_folder + '/' + figure_name + '_z_p_%d' + '_vh_%d' % data_idx,
+                       matplotlib.cm.hot, 0, 3*thresh)
+
+            for p, mean_screen in enumerate(_all_data.mean(0), 1):
+                #z_screen_figure.save(mean_screen, ..., vmin=0, vmax=3*thresh)
+                z_screen_figure.save(mean_screen, figure_folder + '/' + figure_name + '_screen_z_p_%d_vh_%d.png' % (p, data_idx) )
 
         this_data[this_data < thresh] = 0
 
-        plt.clf()
         plot_data = this_data
         masked_array = np.ma.array (plot_data, mask=np.isnan(this_data))
-        cmap = matplotlib.cm.gray
-        cmap.set_bad('black',1.)
-        plt.imshow(masked_array, interpolation='nearest', aspect='auto', cmap=cmap)
-        #plt.imshow(this_data, aspect='auto')
-        plt.colorbar()
-        fig.savefig(figure_folder + '/' + figure_name + '_z_%d.png' % data_idx )
-        plt.clf()
+        z_thresh_figure.save(masked_array, figure_folder + '/' + figure_name + '_z_%d.png' % data_idx )
 
        # save for PCI
         with open((root_dir + '/z_' + figure_name + '_%d.pickle') % data_idx, 'w') as fz:
@@ -138,36 +145,16 @@ for idx, next_file in enumerate(all_files):
 
 
     for data_idx, this_data in enumerate(results['any']):
-        fig = plt.figure()
-        #plt.set_cmap('gray')
 
         #downsample = 20
         #this_data = np.array([1 * (np.any(this_data[x:x + downsample-1, :], 0)) for x in range(0, this_data.shape[0], downsample)])
 
         plot_data = this_data
-        cmap = matplotlib.cm.gray
-        plt.imshow(plot_data, interpolation='nearest', aspect='auto', cmap=cmap, vmax=1, vmin=0)
-        #plt.imshow(this_data, aspect='auto')
-        plt.colorbar()
-        fig.savefig(figure_folder + '/' + figure_name + '_any_%d.png' % data_idx )
-        plt.clf()
-
-        #cbaron = False
-        #if np.mod(this_data.shape[0],2) == 0:
-        #    D = np.int64(np.round(np.sqrt(this_data.shape[0]/P)))
-        #    N = this_data.shape[0]
-        #    print('saving figures for animation')
-        #    for t in range(0,this_data.shape[1]-1):
-        #        for p in range(1,P+1,1):
-        #            p1 = (p-1)*N/P
-        #            p2 = p1+(N/P)
-        #            this_screen = this_data[p1:p2,t].reshape(D,D)
-        #            plt.imshow(this_screen, interpolation='nearest', aspect='auto', cmap=cmap, vmax = 1, vmin=0)
-        #            if not cbaron:
-        #                plt.colorbar()
-        #                cbaron = True
-        #            fig.savefig(movie_folder + '/' + figure_name + '_p_%d_vh_%d_t_%d.png' % (p, data_idx, t) )
+        any_figure.save(plot_data, figure_folder + '/' + figure_name + '_any_%d.png' % data_idx )
 
+        #if screen_render.grid_size(this_data.shape[0], P) is not None:
+        #    save_movie(screen_render.screens(this_data, P), movie_folder + '/' + figure_name + '_any_p_%d' + '_vh_%d' % data_idx,
+        #               matplotlib.cm.gray, 0, 1)
 
         # save for PCI
         with open((root_dir + '/any_' + figure_name + '_%d.pickle') % data_idx, 'w') as fz:
@@ -176,35 +163,18 @@ for idx, next_file in enumerate(all_files):
 
 
     for data_idx, this_data in enumerate(results['mean']):
-        fig = plt.figure()
-        plt.set_cmap('gray')
-        plt.imshow(this_data, aspect='auto')
-        plt.colorbar()
-        fig.savefig(figure_folder + '/' + figure_name + '_mean_%d.png' % data_idx )
-        plt.clf()
+        mean_figure.save(this_data, figure_folder + '/' + figure_name + '_mean_%d.png' % data_idx )
 
         # If spatial coarse graining in the compile script left a square, plot/save the screen
-        D = np.sqrt(this_data.shape[0]/P)
-        if D%1 == 0.0:
-            D = np.int64(D)
-            N = this_data.shape[0]
+        if screen_render.grid_size(this_data.shape[0], P) is not None:
+            _all_data = screen_render.screens(this_data, P)
             print('saving figures for animation')
-            for t in range(0,this_data.shape[1]-1):
-                for p in range(1,P+1,1):
-                    p1 = (p-1)*N/P
-                    p2 = p1+(N/P)
-                    this_screen = this_data[p1:p2,t].reshape(D,D)
-                    _all_data[t,p-1,:,:] = this_screen
-                    #plt.imshow(this_screen > 0, interpolation='nearest', aspect='auto', cmap=cmap, vmax = 1, vmin=0)
-                    #fig.savefig(movie_folder + '/' + figure_name + '_p_%d_vh_%d_t_%d.png' % (p, data_idx, t) )
-
-            for p in range(1,P+1,1):
-                mean_screen = np.mean(_all_data[:,p-1,:,:],0)
-                plt.clf()
-                plt.imshow(mean_screen, interpolation='nearest', aspect='auto', cmap=cmap)
-                plt.colorbar()
-                #plt.imshow(mean_screen, interpolation='nearest', aspect='auto', cmap=cmap, vmax = 1, vmin=0)
-                fig.savefig(figure_folder + '/' + figure_name + '_screen_mean_p_%d_vh_%d.png' % (p, data_idx) )
+            #save_movie(_all_data, movie_folder + '/' + figure_name + '_mean_p_%d' + '_vh_%d' % data_idx,
+            #           matplotlib.cm.gray, 0, 1)
+
+            for p, mean_screen in enumerate(_all_data.mean(0), 1):
+                #mean_screen_figure.save(mean_screen, ..., vmin=0, vmax=1)
+                mean_screen_figure.save(mean_screen, figure_folder + '/' + figure_name + '_screen_mean_p_%d_vh_%d.png' % (p, data_idx) )
 
     #ims = []
     #for t in range(0,this_neurons.shape[1]-1):
@@ -6,6 +6,18 @@
 # leonardo.barbosa@usp.br
 # 21/09/2016
 #
+# Needs Python 3 and NumPy 1.17 or later (packed rasters unpack with bitorder).
+
+import array
+import atexit
+import binascii
+import collections
+import functools
+import multiprocessing
+import os
+import pickle
+import tempfile
+import time
 
 import numpy as np
 
@@ -14,16 +26,191 @@ def rolling_window(a, size):
     strides = a.strides + (a. strides[-1],)
     return np.lib.stride_tricks.as_strided(a, shape=shape, strides=strides)
 
-def pci(L):
-    l1 = L.shape[0]-1
-
+def _as_2d(L):
     if len(L.shape) > 1:
         if len(L.shape) > 2:
             raise Exception('data has to be 1D or 2D')
-        l2 = L.shape[1]-1
     else:
         L = L.reshape([len(L), 1])
-        l2 = 0
+    return L
+
+_POPCOUNT = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
+
+class PackedRaster(object):
+    """Raster of small integer symbols stored as bits, one row of uint64
+    words per column.
+
+    Each entry takes bits bits (1, 2, 4 or 8): bits b * bits to
+    (b + 1) * bits - 1 of a column's words hold entry (b, r), least
+    significant first. A binary 10000 x 2500 raster takes 157 words per
+    column instead of 10000 floats; silent/regular/burst states (0, 1, 2)
+    fit in bits=2. Build one with PackedRaster.pack and get the dense uint8
+    matrix back with unpack (np.asarray also works).
+    """
+
+    def __init__(self, words, nrows, bits=1):
+        self.words = words
+        self.shape = (nrows, words.shape[0])
+        self.bits = int(bits)
+
+    @classmethod
+    def pack(cls, data, bits=1):
+        """Pack a dense 1D or 2D array. With bits=1 nonzero entries become
+        1, otherwise entries have to be integers in [0, 2 ** bits)."""
+        if bits not in (1, 2, 4, 8):
+            raise ValueError('bits has to be 1, 2, 4 or 8, got %r' % (bits,))
+        # a NumPy integer would overflow the 64 bit masks
+        bits = int(bits)
+        data = _as_2d(np.asarray(data))
+        nrows = data.shape[0]
+        nwords = -(-nrows * bits // 64)
+        flat = np.zeros((data.shape[1], nwords * 64), dtype=np.uint8)
+        if bits == 1:
+            flat[:, :nrows] = data.T != 0
+        else:
+            if not np.all((data == np.round(data)) & (data >= 0) & (data < 2 ** bits)):
+                raise ValueError('%d bit entries have to be integers in [0, %d)' % (bits, 2 ** bits))
+            codes = data.T.astype(np.uint8)[:, :, None]
+            flat[:, :nrows * bits] = np.unpackbits(codes, axis=2, count=bits, bitorder='little').reshape(data.shape[1], nrows * bits)
+        return cls(np.packbits(flat, axis=1, bitorder='little').view('<u8'), nrows, bits)
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+    @property
+    def nsymbols(self):
+        return 1 << self.bits
+
+    def count_nonzero(self):
+        # padding bits are always 0
+        words = np.ascontiguousarray(self.words, dtype='<u8')
+        if self.bits > 1:
+            # fold each entry onto its lowest bit
+            fold = words.copy()
+            for b in range(1, self.bits):
+                fold |= words >> np.uint64(b)
+            words = fold & np.uint64(_low_bits(64 // self.bits, self.bits))
+        return int(_POPCOUNT[words.view(np.uint8)].sum(dtype=np.int64))
+
+    def _codes(self, words):
+        # entries of the rows of words, as uint8
+        words = np.ascontiguousarray(words, dtype='<u8')
+        flat = np.unpackbits(words.view(np.uint8), axis=-1, count=self.shape[0] * self.bits, bitorder='little')
+        if self.bits == 1:
+            return flat
+        entries = flat.reshape(flat.shape[:-1] + (self.shape[0], self.bits))
+        return np.packbits(entries, axis=-1, bitorder='little')[..., 0]
+
+    def column(self, r):
+        """Entries of column r as a uint8 vector."""
+        return self._codes(self.words[r])
+
+    def unpack(self):
+        return self._codes(self.words).T
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.unpack()
+        return data if dtype is None else data.astype(dtype)
+
+    def __getitem__(self, key):
+        # only data[rows, cols] with slices, e.g. data[:10000, 500:3000]
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        rows, cols = key
+        if not isinstance(rows, slice) or not isinstance(cols, slice):
+            raise TypeError('PackedRaster can only be sliced, got %r' % (key,))
+        words = self.words[cols]
+        if rows == slice(None):
+            return PackedRaster(words, self.shape[0], self.bits)
+        start, stop, step = rows.indices(self.shape[0])
+        if step == 1 and start * self.bits % 64 == 0:
+            # rows starting on a word: a view of their words (e.g. of a
+            # memmapped store), copied only to clear the bits past stop
+            nrows = max(stop - start, 0)
+            first = start * self.bits // 64
+            words = words[:, first:first - (-nrows * self.bits // 64)]
+            if nrows * self.bits % 64:
+                words = words.copy()
+                words[:, -1] &= np.uint64(_low_bits(nrows * self.bits % 64, 1))
+            return PackedRaster(words, nrows, self.bits)
+        return PackedRaster.pack(PackedRaster(words, self.shape[0], self.bits).unpack()[rows], self.bits)
+
+def _low_bits(n, bits):
+    # the lowest bit of each of n entries of bits bits
+    return ((1 << n * bits) - 1) // ((1 << bits) - 1)
+
+def pci(L, engine='suffix', stats=False, stop_above=None, stop_below=None):
+    """Lempel-Ziv complexity of the matrix L, parsed column by column.
+
+    L is a 1D or 2D array or a PackedRaster. engine selects the
+    implementation: 'suffix' (default) keeps a suffix automaton per column
+    and runs in linear time, 'bitparallel' tests all match positions of a
+    raster of small integers (binary, or e.g. silent/regular/burst states
+    0/1/2) at once on its packed words, 'reference' is the original rolling
+    window search. All of them return the same value.
+
+    With stats=True the result is (c, PCIStats) instead of c.
+
+    stop_above and stop_below stop the parse (suffix engine only) as soon
+    as c is known to be above stop_above or below stop_below, returning a
+    lower or upper bound of c on that side instead; c itself is returned
+    otherwise. Either way the result compares to the thresholds like c:
+    pci(L, stop_above=t) > t exactly when pci(L) > t, and
+    pci(L, stop_below=t) < t exactly when pci(L) < t.
+    """
+    if engine not in _ENGINES:
+        raise ValueError('unknown PCI engine %r (expected one of %s)' % (engine, ', '.join(sorted(_ENGINES))))
+    run = _stopping(engine, stop_above, stop_below)
+    if not isinstance(L, PackedRaster):
+        L = _as_2d(L)
+    if not stats:
+        return run(L)
+    stats = PCIStats(engine, L.shape[1])
+    return run(L, stats), stats
+
+def _stopping(engine, stop_above, stop_below):
+    if stop_above is None and stop_below is None:
+        return _ENGINES[engine]
+    if engine != 'suffix':
+        raise ValueError('stop_above and stop_below need the suffix engine, got %r' % (engine,))
+    return functools.partial(_pci_suffix, stop_above=stop_above, stop_below=stop_below)
+
+class PCIStats(object):
+    """What a pci(..., stats=True) call did.
+
+    iterations       parse steps: loop iterations for the reference and
+                     bitparallel engines, phrase searches for suffix
+    comparisons      symbol comparisons: window entries compared
+                     (reference), bits combined into match masks
+                     (bitparallel), automaton transitions (suffix)
+    peak_temp_bytes  largest temporary: the rolling_window comparison
+                     (reference), a match mask (bitparallel), a column
+                     automaton (suffix)
+    column_time      seconds spent on each column
+    stopped          first column left unparsed by stop_above/stop_below,
+                     None if the parse went to the end
+    """
+
+    def __init__(self, engine, ncols):
+        self.engine = engine
+        self.iterations = 0
+        self.comparisons = 0
+        self.peak_temp_bytes = 0
+        self.column_time = np.zeros(ncols)
+        self.stopped = None
+
+    def __repr__(self):
+        return ('PCIStats(engine=%r, iterations=%d, comparisons=%d, peak_temp_bytes=%d, time=%.3fs, slowest column=%d, stopped=%r)'
+                % (self.engine, self.iterations, self.comparisons, self.peak_temp_bytes,
+                   self.column_time.sum(), np.argmax(self.column_time) if len(self.column_time) else -1, self.stopped))
+
+def _pci_reference(L, stats=None):
+    if isinstance(L, PackedRaster):
+        L = L.unpack()
+
+    l1 = L.shape[0]-1
+    l2 = L.shape[1]-1
 
     c=1
     r=0
@@ -33,22 +220,26 @@ def pci(L):
 
     stop = False
 
-    n_iterations = 0
     while not stop:
 
+        if stats is not None:
+            started = time.time()
+            column = r
+
         if q == r:
             a = i+k-1
         else:
             a=l1
 
-#        n_iterations += 1
-#        print "Iteration #%d: (c=%d, r=%d, q=%d ,k=%d ,i=%d ,a=%d)" % (n_iterations, c, r, q, k, i, a)
-
-
         d = L[i:i+k,r]
         e = L[0:a,q]
         found = np.all(rolling_window(e, len(d)) == d, axis=1)
 
+        if stats is not None:
+            stats.iterations += 1
+            stats.comparisons += max(len(e) - len(d) + 1, 0) * len(d)
+            stats.peak_temp_bytes = max(stats.peak_temp_bytes, max(len(e) - len(d) + 1, 0) * len(d))
+
         if found.any():
 
             k += 1
@@ -83,11 +274,1005 @@ def pci(L):
                     q = r
                     k = 1
 
+        if stats is not None:
+            stats.column_time[column] += time.time() - started
+
+    return c
+
+# Online suffix automaton (Blumer et al. 1985) over integer symbols 0..nsymbols-1.
+# Transitions are kept in one flat list, nsymbols entries per state, or, past
+# _DENSE_SYMBOLS symbols (e.g. real valued rasters), in a dict of the ones that
+# exist, at most three per symbol of text. Either way state st goes to
+# next[st * nsymbols + x] on x, -1 if it has no such transition.
+_DENSE_SYMBOLS = 16
+
+class _Transitions(dict):
+
+    def __missing__(self, key):
+        return -1
+
+class _SuffixAutomaton(object):
+
+    def __init__(self, nsymbols, compact=False):
+        # compact keeps the tables in 4 byte typed arrays instead of lists,
+        # about a fifth of the memory for a quarter more time
+        self._table = (lambda x: array.array('i', x)) if compact else list
+        self.nsymbols = nsymbols
+        self.link = self._table([-1])
+        self.length = self._table([0])
+        self.last = 0
+        self.size = 0
+        if nsymbols > _DENSE_SYMBOLS:
+            self._sparse([-1] * nsymbols)
+        else:
+            self.next = self._table([-1] * nsymbols)
+            # symbols of each state's transitions, sparse tables only
+            self.out = None
+
+    def _sparse(self, dense):
+        # switch to a sparse table holding the transitions of the dense one
+        ns = self.nsymbols
+        self.next = _Transitions()
+        self.out = [[] for _ in self.length]
+        for key, target in enumerate(dense):
+            if target != -1:
+                self.next[key] = target
+                self.out[key // ns].append(key % ns)
+
+    def extend(self, x):
+        """Append symbol x. Returns (state, clone) when a state had to be split, None otherwise."""
+        ns = self.nsymbols
+        nxt = self.next
+        link = self.link
+        length = self.length
+        out = self.out
+
+        cur = len(length)
+        length.append(length[self.last] + 1)
+        link.append(0)
+        if out is None:
+            nxt.extend([-1] * ns)
+        else:
+            out.append([])
+
+        p = self.last
+        while p != -1 and nxt[p * ns + x] == -1:
+            nxt[p * ns + x] = cur
+            if out is not None:
+                out[p].append(x)
+            p = link[p]
+
+        split = None
+        if p != -1:
+            q = nxt[p * ns + x]
+            if length[p] + 1 == length[q]:
+                link[cur] = q
+            else:
+                clone = len(length)
+                length.append(length[p] + 1)
+                link.append(link[q])
+                if out is None:
+                    nxt.extend(nxt[q * ns:(q + 1) * ns])
+                else:
+                    for y in out[q]:
+                        nxt[clone * ns + y] = nxt[q * ns + y]
+                    out.append(list(out[q]))
+                while p != -1 and nxt[p * ns + x] == q:
+                    nxt[p * ns + x] = clone
+                    p = link[p]
+                link[q] = clone
+                link[cur] = clone
+                split = (q, clone)
+
+        self.last = cur
+        self.size += 1
+        return split
+
+    def extend_to(self, s, size):
+        while self.size < size:
+            self.extend(s[self.size])
+
+    def grow(self, nsymbols):
+        """Widen the transition table to nsymbols symbols."""
+        if self.out is not None:
+            old = self.nsymbols
+            self.next = _Transitions((key // old * nsymbols + key % old, target) for key, target in self.next.items())
+            self.nsymbols = nsymbols
+            return
+        table = np.full((len(self.length), nsymbols), -1, dtype=np.int64)
+        table[:, :self.nsymbols] = np.reshape(self.next, (-1, self.nsymbols))
+        self.nsymbols = nsymbols
+        if nsymbols > _DENSE_SYMBOLS:
+            self._sparse(table.ravel().tolist())
+        else:
+            self.next = self._table(table.ravel().tolist())
+
+    def nbytes(self):
+        # list slots only, the small ints they point to are shared; about 100
+        # bytes per dict entry and its out list slot
+        slot = 8 if self._table is list else 4
+        if self.out is not None:
+            return slot * (len(self.link) + len(self.length)) + 100 * len(self.next)
+        return slot * (len(self.next) + len(self.link) + len(self.length))
+
+def _self_match(sam, s, i, k, l1):
+    # Grow k while s[i:i+k] occurs in s[0:i+k-1], extending the automaton one
+    # symbol ahead of the phrase. Entered with k == 1, so the walk starts at the
+    # root; if extending the text splits the state holding the phrase, the
+    # phrase moves to the clone.
+    ns = sam.nsymbols
+    nxt = sam.next
+    length = sam.length
+    st = 0
+    while True:
+        while sam.size < i + k - 1:
+            split = sam.extend(s[sam.size])
+            if split is not None and split[0] == st and k - 1 <= length[split[1]]:
+                st = split[1]
+        st = nxt[st * ns + s[i + k - 1]]
+        if st == -1:
+            return k
+        k += 1
+        if i + k > l1:
+            return k
+
+def _cross_match(sam, s, i, k, l1):
+    # Grow k while s[i:i+k] occurs in the (fixed) text of sam
+    ns = sam.nsymbols
+    nxt = sam.next
+    st = 0
+    for j in range(i, i + k):
+        st = nxt[st * ns + s[j]]
+        if st == -1:
+            return k
+    k += 1
+    while i + k <= l1:
+        st = nxt[st * ns + s[i + k - 1]]
+        if st == -1:
+            return k
+        k += 1
+    return k
+
+def _count_match(stats, i, k, l1):
+    # a search from k == 1 that stopped at k followed k transitions on a
+    # miss and k - 1 when it ran into the end of the column
+    stats.iterations += 1
+    stats.comparisons += k if i + k <= l1 else k - 1
+
+def _column_phrases(prev, s, l1, ns, stats=None):
+    # Phrases closed while parsing column s (column 3 or later), given prev, the
+    # automaton of the first l1 symbols of the previous column. The first phrase
+    # is searched in the previous column, the others in the column's own prefix.
+    # Returns the count and the automaton of the first l1 symbols of s.
+    own = _SuffixAutomaton(ns)
+    count = 0
+    i = 0
+    k = _cross_match(prev, s, i, 1, l1)
+    if stats is not None:
+        _count_match(stats, i, k, l1)
+    while i + k <= l1:
+        count += 1
+        i = i + k
+        if i + 1 > l1:
+            break
+        k = _self_match(own, s, i, 1, l1)
+        if stats is not None:
+            _count_match(stats, i, k, l1)
+    own.extend_to(s, l1)
+    if stats is not None:
+        stats.peak_temp_bytes = max(stats.peak_temp_bytes, own.nbytes())
+    return count, own
+
+# Column access for _pci_suffix: symbols(col) gives the symbol codes of a
+# column as a list, same_prefix(a, b, size) compares the first size entries
+# of two columns.
+class _DenseColumns(object):
+
+    def __init__(self, codes, nsymbols):
+        # codes[col] holds the symbol codes of column col
+        self.codes = codes
+        self.nsymbols = nsymbols
+        self.shape = codes.shape[::-1]
+
+    @classmethod
+    def encode(cls, L):
+        symbols, codes = np.unique(L, return_inverse=True)
+        return cls(np.ascontiguousarray(codes.reshape(L.shape).T), len(symbols))
+
+    def dense(self):
+        return self.codes.T
+
+    def columns(self, start, stop):
+        return _DenseColumns(self.codes[start:stop], self.nsymbols)
+
+    def symbols(self, col):
+        return self.codes[col].tolist()
+
+    def same_prefix(self, a, b, size):
+        return np.array_equal(self.codes[a, :size], self.codes[b, :size])
+
+class _PackedColumns(object):
+
+    def __init__(self, P):
+        self.P = P
+        self.shape = P.shape
+        self.nsymbols = P.nsymbols
+
+    def dense(self):
+        return self.P
+
+    def columns(self, start, stop):
+        return _PackedColumns(self.P[:, start:stop])
+
+    def symbols(self, col):
+        return self.P.column(col).tolist()
+
+    def same_prefix(self, a, b, size):
+        # whole words first, then the bits of the last partial word
+        nfull, rest = divmod(size * self.P.bits, 64)
+        wa = self.P.words[a]
+        wb = self.P.words[b]
+        if not np.array_equal(wa[:nfull], wb[:nfull]):
+            return False
+        return rest == 0 or (wa[nfull] ^ wb[nfull]) & np.uint64((1 << rest) - 1) == 0
+
+def _pci_suffix(L, stats=None, stop_above=None, stop_below=None):
+    # Same value as _pci_reference. In the reference parse a miss only closes a
+    # phrase when q - 1 > 0, so the first three columns never close one (their
+    # misses fall through to the wrap-around search over L[:, -1], L[:, -2],
+    # ..., which always ends at the column itself), and every later column starts
+    # afresh at i = 0, q = r - 1. Hence c = 2 + the phrases closed in each
+    # column r >= 3, which depend only on columns r - 1 and r. Each of those is
+    # parsed with suffix automata, visiting every symbol a constant number of
+    # times. L can also be an already encoded _DenseColumns (see pci_many).
+    cols = _columns_of(L)
+
+    if cols.shape[0] < 2:
+        # degenerate columns, nothing to gain
+        return _pci_reference(cols.dense(), stats)
+
+    if stop_above is None and stop_below is None:
+        return 2 + int(_column_counts(cols, 3, stats).sum())
+
+    # c only grows, and the columns from r on can add at most left[r]
+    left = np.concatenate([np.cumsum(_count_bounds(cols)[::-1])[::-1], [0]])
+    c = 2
+    r = min(3, cols.shape[1])
+    if stop_above is not None and c > stop_above:
+        return _stopped(stats, r, cols, c)
+    if stop_below is not None and c + left[r] < stop_below:
+        return _stopped(stats, r, cols, c + left[r])
+    for r, count in _iter_column_counts(cols, 3, stats):
+        c += count
+        if stop_above is not None and c > stop_above:
+            return _stopped(stats, r + 1, cols, c)
+        if stop_below is not None and c + left[r + 1] < stop_below:
+            return _stopped(stats, r + 1, cols, c + left[r + 1])
+    return c
+
+def _stopped(stats, r, cols, bound):
+    if stats is not None and r < cols.shape[1]:
+        stats.stopped = r
+    return int(bound)
+
+def _count_bounds(cols):
+    # Upper bound on the phrases closed in each column. A phrase starting
+    # inside a run of equal symbols copies it from one entry back and closes
+    # past its end, so a column of m runs in its first l1 entries closes at
+    # most 2 m phrases, and at most l1. A column equal to the previous one
+    # closes none.
+    l1 = cols.shape[0] - 1
+    dense = np.asarray(cols.dense())[:l1]
+    runs = 1 + np.count_nonzero(dense[1:] != dense[:-1], axis=0)
+    bounds = np.minimum(2 * runs, l1)
+    bounds[1:][np.all(dense[:, 1:] == dense[:, :-1], axis=0)] = 0
+    return bounds
+
+def _columns_of(L):
+    if isinstance(L, PackedRaster):
+        return _PackedColumns(L)
+    if isinstance(L, _DenseColumns):
+        return L
+    return _DenseColumns.encode(L)
+
+def _column_counts(cols, first=1, stats=None):
+    # counts[r] = phrases closed in column r when the parse reaches it from
+    # column r - 1, for r >= first (0 before)
+    counts = np.zeros(cols.shape[1], dtype=np.int64)
+    for r, count in _iter_column_counts(cols, first, stats):
+        counts[r] = count
+    return counts
+
+def _iter_column_counts(cols, first=1, stats=None):
+    # (r, counts[r]) for r = max(first, 1), ..., one column at a time
+    l1 = cols.shape[0]-1
+    prev = None
+    for r in range(max(first, 1), cols.shape[1]):
+        count = 0
+        if stats is not None:
+            started = time.time()
+        if cols.same_prefix(r, r - 1, l1):
+            # matched in full against the previous column, whose automaton
+            # is also this column's
+            pass
+        else:
+            if prev is None:
+                prev = _SuffixAutomaton(cols.nsymbols)
+                prev.extend_to(cols.symbols(r - 1), l1)
+            count, prev = _column_phrases(prev, cols.symbols(r), l1, cols.nsymbols, stats)
+        if stats is not None:
+            stats.column_time[r] += time.time() - started
+        yield r, count
+
+def pci_windows(L, width, step=1, n_jobs=1):
+    """pci of every window L[:, start:start + width], for start = 0, step,
+    2 * step, ... as long as the window fits.
+
+    The complexity of a window is 2 plus per-column phrase counts that
+    depend only on each column and the one before it (see _pci_suffix), so
+    the counts are computed once for the whole raster, split in chunks of
+    columns over n_jobs processes, and every window is a difference of
+    their running sum.
+    """
+    if width < 1 or step < 1:
+        raise ValueError('width and step have to be at least 1')
+    if not isinstance(L, PackedRaster):
+        L = _as_2d(np.asarray(L))
+    starts = np.arange(0, L.shape[1] - width + 1, step)
+
+    if L.shape[0] < 2:
+        return np.array([pci(L[:, start:start + width]) for start in starts], dtype=np.int64)
+
+    cols = _columns_of(L)
+    m = cols.shape[1]
+    if n_jobs == 1 or m < 4:
+        counts = _column_counts(cols, 3)
+    else:
+        from joblib import Parallel, delayed
+        nchunks = 4 * (n_jobs if n_jobs > 0 else multiprocessing.cpu_count())
+        bounds = np.unique(np.linspace(3, m, nchunks + 1).astype(int))
+        chunks = Parallel(n_jobs=n_jobs)(delayed(_column_counts)(cols.columns(r0 - 1, r1)) for r0, r1 in zip(bounds[:-1], bounds[1:]))
+        counts = np.zeros(m, dtype=np.int64)
+        for r0, r1, chunk in zip(bounds[:-1], bounds[1:], chunks):
+            counts[r0:r1] = chunk[1:]
+
+    total = np.concatenate([[0], np.cumsum(counts)])
+    if width <= 3:
+        return np.full(len(starts), 2, dtype=np.int64)
+    return 2 + total[starts + width] - total[starts + 3]
+
+class PCIStream(object):
+    """Running PCI of a raster that arrives a few columns at a time.
+
+    push appends columns (an (nneurons, ncols) array, a single column or a
+    PackedRaster) and complexity is, at any point, what pci would return for
+    all the columns pushed so far. Only the last column and its suffix
+    automaton are kept between pushes. symbols lists the values the columns
+    can take.
+    """
+
+    def __init__(self, symbols=(0, 1)):
+        self.symbols = np.unique(symbols)
+        self.nrows = None
+        self.ncols = 0
+        self.c = 2
+        self._prev = None
+        self._automaton = None
+
+    @property
+    def complexity(self):
+        return self.c if self.ncols else 0
+
+    def push(self, columns):
+        """Append columns and return the running complexity."""
+        if isinstance(columns, PackedRaster):
+            columns = columns.unpack()
+        columns = _as_2d(np.asarray(columns))
+
+        if self.nrows is None:
+            if columns.shape[0] < 2:
+                raise Exception('columns need at least 2 rows')
+            self.nrows = columns.shape[0]
+        elif columns.shape[0] != self.nrows:
+            raise Exception('expected columns of %d rows, got %d' % (self.nrows, columns.shape[0]))
+
+        codes = np.searchsorted(self.symbols, columns)
+        if not np.array_equal(self.symbols[np.minimum(codes, len(self.symbols) - 1)], columns):
+            raise ValueError('columns have values outside of symbols %s' % self.symbols)
+
+        l1 = self.nrows - 1
+        for col in codes.T:
+            if self.ncols < 3:
+                self._automaton = None
+            elif not np.array_equal(col[:l1], self._prev[:l1]):
+                if self._automaton is None:
+                    self._automaton = _SuffixAutomaton(len(self.symbols))
+                    self._automaton.extend_to(self._prev.tolist(), l1)
+                count, self._automaton = _column_phrases(self._automaton, col.tolist(), l1, len(self.symbols))
+                self.c += count
+            self._prev = col
+            self.ncols += 1
+
+        return self.complexity
+
+def _column_int(words):
+    # bit j of the result is entry j of the column
+    return int(binascii.hexlify(np.ascontiguousarray(words, dtype='<u8').tobytes()[::-1]), 16)
+
+def _symbol_bits(L):
+    # smallest PackedRaster bits that hold the entries of L as they are, or
+    # None if they are not small non-negative integers
+    if _is_binary(L):
+        return 1
+    if L.size and np.all(L == np.round(L)) and L.min() >= 0:
+        for bits in (2, 4, 8):
+            if L.max() < 2 ** bits:
+                return bits
+    return None
+
+def _pack_symbols(L, what='raster'):
+    bits = _symbol_bits(L)
+    if bits is None:
+        raise ValueError('the bitparallel engine needs a %s of integers in [0, 256)' % what)
+    return PackedRaster.pack(L, bits)
+
+def _pci_bitparallel(L, stats=None):
+    # The reference parse on a packed raster. Column q is held as an integer
+    # with its entries every w = L.bits bits. For each symbol v, eq[v] has the
+    # lowest bit of entry j set where the column equals v, so the start
+    # positions j with e[j:j+k] == d are the set bits of AND_t eq[d[t]] >> w*t,
+    # computed a word at a time (shift-and). While k grows for the same phrase
+    # and search column the mask is extended by one term per step.
+    if not isinstance(L, PackedRaster):
+        L = _pack_symbols(L)
+
+    l1 = L.shape[0]-1
+    l2 = L.shape[1]-1
+
+    if l1 < 1:
+        return _pci_reference(L, stats)
+
+    w = L.bits
+    symbol = L.nsymbols - 1
+    ones = _low_bits(l1 + 1, w)
+    prefix = (1 << w * l1) - 1
+    columns = {}
+
+    def column(col):
+        # (eq[0], ..., eq[nsymbols - 1], entries)
+        if col not in columns:
+            x = _column_int(L.words[col])
+            eq = []
+            for v in range(L.nsymbols):
+                same = ~(x ^ v * ones)
+                match = same
+                for b in range(1, w):
+                    match &= same >> b
+                eq.append(match & ones)
+            columns[col] = tuple(eq) + (x,)
+        return columns[col]
+
+    c=1
+    r=0
+    q=0
+    k=1
+    i=0
+
+    mask = ones
+    mask_for = None
+
+    while True:
+
+        if stats is not None:
+            started = time.time()
+            column_r = r
+
+        if q == r:
+            a = i+k-1
+        else:
+            a=l1
+
+        if q < -(l2 + 1):
+            raise IndexError('index %d is out of bounds for axis 1 with size %d' % (q, l2 + 1))
+
+        e = column(q % (l2 + 1))
+        d = column(r)[-1] >> w * i
+        if mask_for == (r, q, i, k - 1):
+            mask &= e[(d >> w * (k - 1)) & symbol] >> w * (k - 1)
+            terms = 1
+        else:
+            mask = ones
+            for t in range(k):
+                mask &= e[(d >> w * t) & symbol] >> w * t
+            terms = k
+        mask_for = (r, q, i, k)
+
+        if stats is not None:
+            stats.iterations += 1
+            stats.comparisons += terms * (l1 + 1)
+            stats.peak_temp_bytes = max(stats.peak_temp_bytes, (w * (l1 + 1) + 7) // 8)
+            stats.column_time[column_r] += time.time() - started
+
+        found = a - k + 1 > 0 and mask & ((1 << w * (a - k + 1)) - 1)
+
+        if found:
+
+            k += 1
+            if i+k > l1:
+                r += 1
+                # identical columns are matched in full, skip them
+                while r <= l2 and (column(r)[-1] ^ column(r - 1)[-1]) & prefix == 0:
+                    r += 1
+                if r > l2:
+                    c += 1
+                    break
+                else:
+                    i = 0
+                    q = r - 1
+                    k = 1
+        else:
+
+            q -= 1
+            if q > 0:
+
+                c += 1
+                i = i + k
+                if i + 1 > l1:
+
+                    r += 1
+                    while r <= l2 and (column(r)[-1] ^ column(r - 1)[-1]) & prefix == 0:
+                        r += 1
+                    if r > l2:
+                        c += 1
+                        break
+                    else:
+                        i = 0
+                        q = r - 1
+                        k = 1
+                else:
+
+                    q = r
+                    k = 1
+
     return c
 
+# Bump when a change here can change the complexities the engines return;
+# cached results (pci_jobs) are keyed by it.
+ENGINE_VERSION = 1
+
+_ENGINES = {
+    'bitparallel': _pci_bitparallel,
+    'reference': _pci_reference,
+    'suffix': _pci_suffix,
+}
+
+def events_to_cells(senders, times, gids, window, bin_width=1.):
+    """Active (row, column) cells of the raster binned from spike events.
+
+    Rows are GIDs gids[0] to gids[1] inclusive and columns bin_width ms
+    bins of the window, as in spike_raster.bin_spikes. Returns the raster
+    shape and the rows and columns of its nonzero cells, sorted by column
+    and then row.
+    """
+    import spike_raster
+    shape, rows, cols = spike_raster.spike_cells(senders, times, gids, window, bin_width)
+    nrows = max(shape[0], 1)
+    cells = np.unique(cols * nrows + rows)
+    return shape, cells % nrows, cells // nrows
+
+def pci_from_events(senders, times, gids, window, bin_width=1.):
+    """pci of the binary raster binned from spike events (see
+    events_to_cells), without building the raster: columns are filled in
+    one at a time from the events and fed to a PCIStream, so memory is one
+    column plus the events.
+    """
+    shape, rows, cols = events_to_cells(senders, times, gids, window, bin_width)
+    if shape[0] < 2:
+        data = np.zeros(shape, dtype=np.uint8)
+        data[rows, cols] = 1
+        return pci(data)
+
+    bounds = np.searchsorted(cols, np.arange(shape[1] + 1))
+    stream = PCIStream()
+    column = np.zeros(shape[0], dtype=np.uint8)
+    for r in range(shape[1]):
+        active = rows[bounds[r]:bounds[r + 1]]
+        column[active] = 1
+        stream.push(column)
+        column[active] = 0
+    return stream.complexity
+
+def _is_binary(L):
+    return bool(np.all((L == 0) | (L == 1)))
+
+def _encode_trials(trials, flat=None):
+    # One alphabet for all dense trials, codes stored in the smallest
+    # unsigned type and transposed to column rows once.
+    if flat is None:
+        flat = np.concatenate([x.ravel() for x in trials])
+    symbols, codes = np.unique(flat, return_inverse=True)
+    codes = codes.astype(np.min_scalar_type(max(len(symbols) - 1, 0)))
+    encoded = []
+    start = 0
+    for x in trials:
+        block = codes[start:start + x.size].reshape(x.shape)
+        encoded.append(_DenseColumns(np.ascontiguousarray(block.T), len(symbols)))
+        start += x.size
+    return encoded
+
+def pci_many(stack, engine='suffix', n_jobs=1, verbose=0, stop_above=None, stop_below=None):
+    """PCI of every trial in stack, as an int array.
+
+    stack is an (ntrials, nneurons, ntime) array or a list of 2D arrays
+    and/or PackedRasters, possibly of different shapes. Work common to all
+    trials is done once up front: dense trials are encoded over one shared
+    alphabet into a compact buffer (suffix engine) or packed (bitparallel
+    engine). The trials are then spread over n_jobs worker processes with
+    joblib (n_jobs=-1 uses every core). stop_above and stop_below are
+    passed on to pci.
+    """
+    if engine not in _ENGINES:
+        raise ValueError('unknown PCI engine %r (expected one of %s)' % (engine, ', '.join(sorted(_ENGINES))))
+    run = _stopping(engine, stop_above, stop_below)
+
+    flat = None
+    if isinstance(stack, np.ndarray):
+        if len(stack.shape) != 3:
+            raise Exception('stack has to be 3D (ntrials, nneurons, ntime)')
+        trials = list(stack)
+        flat = stack.reshape(-1)
+    else:
+        trials = [x if isinstance(x, PackedRaster) else _as_2d(np.asarray(x)) for x in stack]
+
+    dense = [t for t, x in enumerate(trials) if not isinstance(x, PackedRaster)]
+    if engine == 'suffix' and dense:
+        encoded = _encode_trials([trials[t] for t in dense], flat if len(dense) == len(trials) else None)
+        for t, x in zip(dense, encoded):
+            trials[t] = x
+    elif engine == 'bitparallel':
+        for t in dense:
+            trials[t] = _pack_symbols(trials[t], 'raster (trial %d)' % t)
+
+    if n_jobs == 1 or len(trials) < 2:
+        return np.array([run(x) for x in trials], dtype=np.int64)
+
+    from joblib import Parallel, delayed
+    results = Parallel(n_jobs=n_jobs, verbose=verbose)(delayed(run)(x) for x in trials)
+    return np.array(results, dtype=np.int64)
+
+def _surrogate(shape, density, seed):
+    # random binary raster with round(density * size) ones at shuffled positions
+    size = int(np.prod(shape))
+    data = np.zeros(size, dtype=np.uint8)
+    data[np.random.RandomState(seed).permutation(size)[:int(round(density * size))]] = 1
+    return data.reshape(shape)
+
+def _surrogate_pci(shape, density, seed, engine):
+    return pci(_surrogate(shape, density, seed), engine=engine)
+
+class NormalizationTable(object):
+    """Surrogate complexities used by pci_normalized, cached on disk.
+
+    The entry for (shape, density, nseeds) is the mean pci of nseeds random
+    rasters of that shape with the same fraction of ones (seeds 0 to
+    nseeds-1). Densities are rounded relative to their magnitude, to
+    resolution times their leading power of ten, so that rasters of similar
+    activity share an entry and a sparse raster never rounds to an empty
+    one. The table lives in a pickle at path (None keeps it in memory only)
+    and keeps at most max_entries entries, dropping the least recently used
+    ones; the order of use is saved every save_every lookups that hit and
+    at exit.
+    """
+
+    def __init__(self, path=None, max_entries=1000, resolution=1e-3, engine='suffix', save_every=100):
+        self.path = path
+        self.max_entries = max_entries
+        self.resolution = resolution
+        self.engine = engine
+        self.save_every = save_every
+        self.entries = collections.OrderedDict()
+        # hits whose order of use is not saved yet
+        self._unsaved = 0
+        if path is not None:
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    self.entries = pickle.load(f)
+            atexit.register(self._save_order)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, shape, density, nseeds):
+        density = float(density)
+        if density > 0:
+            scale = 10. ** np.floor(np.log10(density))
+            density = float('%.12g' % (round(density / scale / self.resolution) * self.resolution * scale))
+        return (tuple(int(x) for x in shape), density, int(nseeds))
+
+    def lookup(self, shape, density, nseeds=10):
+        """Mean surrogate complexity, computed and stored on a miss."""
+        key = self.key(shape, density, nseeds)
+        if key not in self.entries:
+            self.precompute([key[0]], [key[1]], nseeds)
+        elif next(reversed(self.entries)) != key:
+            self._unsaved += 1
+        # most recently used last
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        if self._unsaved >= self.save_every:
+            self.save()
+        return value
+
+    def precompute(self, shapes, densities, nseeds=10, n_jobs=1, verbose=0):
+        """Fill in every missing (shape, density) entry, surrogates spread over n_jobs processes."""
+        keys = []
+        for shape in shapes:
+            for density in densities:
+                key = self.key(shape, density, nseeds)
+                if key not in self.entries and key not in keys:
+                    keys.append(key)
+        if not keys:
+            return
+
+        jobs = [(key[0], key[1], seed, self.engine) for key in keys for seed in range(key[2])]
+        if n_jobs == 1:
+            values = [_surrogate_pci(*job) for job in jobs]
+        else:
+            from joblib import Parallel, delayed
+            values = Parallel(n_jobs=n_jobs, verbose=verbose)(delayed(_surrogate_pci)(*job) for job in jobs)
+
+        start = 0
+        for key in keys:
+            self.entries[key] = float(np.mean(values[start:start + key[2]]))
+            start += key[2]
+        self.save()
+
+    def save(self):
+        """Write the table, merged with entries other processes saved meanwhile."""
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                saved = pickle.load(f)
+            # entries only the others have count as older than any used here
+            merged = collections.OrderedDict((key, value) for key, value in saved.items() if key not in self.entries)
+            merged.update(self.entries)
+            self.entries = merged
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self._unsaved = 0
+        if self.path is None:
+            return
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(self.entries, f)
+        os.rename(tmp, self.path)
+
+    def _save_order(self):
+        if self._unsaved:
+            self.save()
+
+_default_table = None
+
+def default_table():
+    """Normalisation table at ~/.pci_normalization.pickle"""
+    global _default_table
+    if _default_table is None:
+        _default_table = NormalizationTable(os.path.join(os.path.expanduser('~'), '.pci_normalization.pickle'))
+    return _default_table
+
+def pci_normalized(L, nseeds=10, table=None, engine='suffix'):
+    """pci of a binary raster divided by the mean pci of shuffled surrogates
+    with the same shape and density, taken from table (default_table() if
+    None). Once the table has the entry this costs the same as pci.
+    """
+    if isinstance(L, PackedRaster):
+        if L.bits != 1:
+            raise ValueError('pci_normalized needs a binary raster')
+        density = L.count_nonzero() / float(L.shape[0] * L.shape[1])
+    else:
+        L = _as_2d(np.asarray(L))
+        if not _is_binary(L):
+            raise ValueError('pci_normalized needs a binary raster')
+        density = np.count_nonzero(L) / float(L.size)
+    if table is None:
+        table = default_table()
+    return pci(L, engine=engine) / table.lookup(L.shape, density, nseeds)
+
+def pci_pyramid(raster, neuron_factors=(1,), time_factors=(1,), pooling='any', n_jobs=1, engine='suffix'):
+    """pci of a binary raster downsampled by every pair of factors.
+
+    Each level is pooling.pool(raster, neuron_factor, time_factor, pooling)
+    (a shorter last block keeps the remaining rows/columns), setting a
+    block when any of its entries is set (pooling='any') or more than half
+    of them are (pooling='majority'), kept packed, and the levels are
+    computed with pci_many over n_jobs processes. Returns one dict per
+    level with 'neuron_factor', 'time_factor', 'shape' and 'pci'.
+    """
+    import pooling as pooling_
+    if pooling not in ('any', 'majority'):
+        raise ValueError('pooling has to be any or majority')
+    if isinstance(raster, PackedRaster):
+        if raster.bits != 1:
+            raise ValueError('pci_pyramid needs a binary raster')
+    else:
+        raster = _as_2d(np.asarray(raster))
+        if not _is_binary(raster):
+            raise ValueError('pci_pyramid needs a binary raster')
+    for factor in tuple(neuron_factors) + tuple(time_factors):
+        if factor < 1:
+            raise ValueError('downsampling factors have to be at least 1')
+
+    table = []
+    levels = []
+    for neuron_factor in neuron_factors:
+        for time_factor in time_factors:
+            level = pooling_.pool(raster, neuron_factor, time_factor, reduce=pooling, packed=True)
+            levels.append(level)
+            table.append({'neuron_factor': neuron_factor, 'time_factor': time_factor, 'shape': level.shape})
+
+    for row, c in zip(table, pci_many(levels, engine=engine, n_jobs=n_jobs)):
+        row['pci'] = int(c)
+    return table
+
+def pci_regions(raster, regions, first_gid=1, unions=(), n_jobs=1, engine='suffix'):
+    """pci of the rows of every region of raster and of unions of regions.
+
+    regions maps population names to inclusive (first GID, last GID)
+    ranges, as the simulation saves them in gids.pickle, and row 0 of
+    raster is GID first_gid (ranges are clipped to the raster). unions
+    lists tuples of region names to combine, their rows taken once and in
+    GID order (none by default: every combination of a gids.pickle's
+    populations would be millions of them). All complexities are
+    computed with pci_many over n_jobs processes. Returns one dict per
+    region (by first GID) and then per union, with 'regions' (tuple of
+    names), 'rows', 'shape' and 'pci'.
+    """
+    if isinstance(raster, PackedRaster):
+        data = raster.unpack()
+    else:
+        data = _as_2d(np.asarray(raster))
+
+    names = sorted(regions, key=lambda name: tuple(regions[name]))
+    rows = {}
+    for name in names:
+        first, last = regions[name]
+        start = max(first - first_gid, 0)
+        stop = min(last - first_gid + 1, data.shape[0])
+        if start >= stop:
+            raise ValueError('region %s (GIDs %d to %d) is outside of the raster' % (name, first, last))
+        rows[name] = np.zeros(data.shape[0], dtype=bool)
+        rows[name][start:stop] = True
+
+    groups = [(name,) for name in names] + [tuple(group) for group in unions or ()]
+
+    bits = _symbol_bits(data)
+    table = []
+    levels = []
+    for group in groups:
+        level = data[np.any([rows[name] for name in group], axis=0)]
+        levels.append(level if bits is None else PackedRaster.pack(level, bits))
+        table.append({'regions': group, 'rows': level.shape[0], 'shape': level.shape})
+
+    for row, c in zip(table, pci_many(levels, engine=engine, n_jobs=n_jobs)):
+        row['pci'] = int(c)
+    return table
+
+# Surrogate null distributions
+#
+# 'spike'  shuffles all entries of the raster (keeps the number of spikes)
+# 'time'   shuffles each row on its own (keeps every neuron's rate)
+# 'neuron' shuffles each column on its own (keeps the population activity
+#          of every time bin)
+SURROGATES = ('spike', 'time', 'neuron')
+
+def shuffle(L, kind, seed):
+    """Surrogate of the 2D array L, see SURROGATES."""
+    rng = np.random.RandomState(seed)
+    if kind == 'spike':
+        return rng.permutation(L.ravel()).reshape(L.shape)
+    if kind == 'time':
+        return np.take_along_axis(L, np.argsort(rng.rand(*L.shape), axis=1), axis=1)
+    if kind == 'neuron':
+        return np.take_along_axis(L, np.argsort(rng.rand(*L.shape), axis=0), axis=0)
+    raise ValueError('unknown surrogate %r (expected one of %s)' % (kind, ', '.join(SURROGATES)))
+
+# source raster of the worker processes, memory mapped read-only
+_null_source = None
+
+def _null_init(path):
+    global _null_source
+    _null_source = np.load(path, mmap_mode='r')
+
+def _null_job(job):
+    index, kind, seed, engine = job
+    return index, pci(shuffle(_null_source, kind, seed), engine=engine)
+
+def surrogate_pcis(L, kind='spike', nsurrogates=100, n_jobs=1, seed=0, engine='suffix'):
+    """Yield (index, pci) of nsurrogates surrogates of L as they finish.
+
+    Surrogate i is shuffle(L, kind, seed + i). The raster is written once
+    to shared memory (/dev/shm when available) and every worker maps it
+    read-only, so only seeds go out and complexities come back.
+    """
+    if kind not in SURROGATES:
+        raise ValueError('unknown surrogate %r (expected one of %s)' % (kind, ', '.join(SURROGATES)))
+    if isinstance(L, PackedRaster):
+        L = L.unpack()
+    L = _as_2d(np.asarray(L))
+    if _is_binary(L):
+        L = L.astype(np.uint8)
+
+    jobs = [(i, kind, seed + i, engine) for i in range(nsurrogates)]
+    if n_jobs == 1:
+        for job in jobs:
+            yield job[0], pci(shuffle(L, kind, job[2]), engine=engine)
+        return
+
+    shm = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    fd, path = tempfile.mkstemp(suffix='.npy', prefix='pci_null_', dir=shm)
+    pool = None
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, L)
+        workers = n_jobs if n_jobs > 0 else multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(workers, _null_init, (path,))
+        for result in pool.imap_unordered(_null_job, jobs, max(1, nsurrogates // (8 * workers))):
+            yield result
+        pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        os.remove(path)
+
+def pci_null(L, kind='spike', nsurrogates=100, n_jobs=1, seed=0, engine='suffix', alternative='less'):
+    """PCI of L against the complexities of nsurrogates surrogates.
+
+    Returns a dict with 'pci', 'null' (the surrogate complexities, in
+    surrogate order) and 'p', the empirical p-value (1 + #extreme) /
+    (1 + nsurrogates), where extreme is null <= pci for alternative='less'
+    (L less complex than chance), null >= pci for 'greater', and the
+    smaller tail doubled for 'two-sided'.
+    """
+    if alternative not in ('less', 'greater', 'two-sided'):
+        raise ValueError('alternative has to be less, greater or two-sided')
+
+    c = pci(L, engine=engine)
+    null = np.zeros(nsurrogates, dtype=np.int64)
+    for index, value in surrogate_pcis(L, kind, nsurrogates, n_jobs, seed, engine):
+        null[index] = value
+
+    less = (1. + np.sum(null <= c)) / (1. + nsurrogates)
+    greater = (1. + np.sum(null >= c)) / (1. + nsurrogates)
+    if alternative == 'less':
+        p = less
+    elif alternative == 'greater':
+        p = greater
+    else:
+        p = min(1., 2 * min(less, greater))
+
+    return {'pci': c, 'null': null, 'p': p, 'kind': kind}
+
+def lz_complexity(s, engine='suffix'):
+    """1D Lempel-Ziv complexity of a sequence.
+
+    s can be a str, bytes, list or NumPy array (raveled), a PackedRaster
+    (read column by column, the order pci parses it) or an iterator of such
+    chunks. engine 'suffix' streams the chunks through an online suffix
+    automaton, linear in the length of s; 'reference' is the original
+    character loop.
+    """
+    if engine == 'suffix':
+        return _lz_suffix(s)
+    if engine != 'reference':
+        raise ValueError("unknown engine %r, expected 'reference' or 'suffix'" % (engine,))
+    if isinstance(s, PackedRaster) or not hasattr(s, '__len__'):
+        # the reference indexes into s, gather packed rasters and chunks first
+        s = np.concatenate(list(_lz_chunks(s)))
+    return _lz_reference(s)
+
 # 1D Lempel-Ziv implementation from: http://stackoverflow.com/questions/4946695/calculating-lempel-ziv-lz-complexity-aka-sequence-complexity-of-a-binary-str
 # Kaspar, F. Schuster, H. Easily calculable measure for the complexity of spatiotemporal patterns. Physical Review A, vol 36, n. 2, p 842.
-def lz_complexity(s):
+def _lz_reference(s):
     i, k, l = 0, 1, 1
     k_max = 1
     n = len(s) - 1
@@ -115,27 +1300,231 @@ def lz_complexity(s):
                 k = 1
     return c
 
+def _lz_chunks(s, size=1 << 20):
+    # 1D arrays of at most size symbols, in order
+    if isinstance(s, PackedRaster):
+        nrows, ncols = s.shape
+        step = max(1, size // max(1, nrows))
+        for start in range(0, ncols, step):
+            yield s[:, start:start + step].unpack().T.ravel()
+        return
+    if isinstance(s, str):
+        s = np.frombuffer(s.encode('utf-32-le'), dtype='<u4')
+    elif isinstance(s, (bytes, bytearray, memoryview)):
+        s = np.frombuffer(s, dtype=np.uint8)
+    elif isinstance(s, (list, tuple)):
+        s = np.asarray(s)
+    elif not isinstance(s, np.ndarray):
+        for chunk in s:
+            for part in _lz_chunks(chunk, size):
+                yield part
+        return
+    s = np.ravel(s)
+    for start in range(0, len(s), size):
+        yield s[start:start + size]
+
+def _lz_suffix(s):
+    # Kaspar-Schuster parse as LZ76 phrases: the phrase starting at l is the
+    # longest m such that s[l:l+m] occurs at some i < l, plus one symbol. It
+    # is found by walking s[l:] through the automaton of s[0:l+m], extended
+    # one symbol ahead of the walk. The reference stops once a phrase ends
+    # within two symbols of the end of s, or three if it copied anything.
+    chunks = _lz_chunks(s)
+    codes = {}
+    sam = _SuffixAutomaton(2, compact=True)
+    buf = []
+    base = 0
+
+    def fill(j):
+        # make sure buf holds s[j] if s is that long, dropping what the
+        # automaton and the walk are done with
+        nonlocal buf, base
+        while j >= base + len(buf):
+            chunk = next(chunks, None)
+            if chunk is None:
+                return False
+            uniq, inverse = np.unique(chunk, return_inverse=True)
+            lut = np.array([codes.setdefault(x, len(codes)) for x in uniq.tolist()], dtype=np.int64)
+            if len(codes) > sam.nsymbols:
+                sam.grow(max(len(codes), 2 * sam.nsymbols))
+            keep = min(sam.size, l) - base
+            base += keep
+            buf = buf[keep:] + lut[np.ravel(inverse)].tolist()
+        return True
+
+    l = 1
+    if not fill(l):
+        raise IndexError('lz_complexity needs at least two symbols')
+    c = 1
+    length = sam.length
+    while True:
+        st = 0
+        m = 0
+        while fill(l + m):
+            while sam.size < l + m:
+                split = sam.extend(buf[sam.size - base])
+                if split is not None and split[0] == st and m <= length[split[1]]:
+                    st = split[1]
+            # looked up each time, a new symbol in the chunk widens the table
+            st = sam.next[st * sam.nsymbols + buf[l + m - base]]
+            if st == -1:
+                break
+            m += 1
+        c += 1
+        if not fill(l + m + (3 if m else 2)):
+            return c
+        l += m + 1
+
+
+def check_engines(shapes=((30, 30), (50, 20), (7, 40), (2, 5), (100, 3), (64,)), densities=(.02, .5, .9), seed=0):
+    """Compare every engine against the reference on random and degenerate matrices."""
+    rng = np.random.RandomState(seed)
+    cases = []
+    for shape in shapes:
+        for density in densities:
+            cases.append(1 * (rng.rand(*shape) < density))
+        cases.append(np.zeros(shape))
+        cases.append(np.ones(shape))
+    # repeated columns, three letter alphabets (silent/regular/burst states,
+    # over several packed words), columns of two symbols, a constant non-zero
+    # state, a 4 bit alphabet, symbols that do not pack and thresholded real
+    # values (more symbols than dense automaton tables take)
+    cases.append(np.tile(1 * (rng.rand(20, 1) > .5), (1, 15)))
+    cases.append(rng.randint(0, 3, (25, 25)))
+    cases.append(np.choose(rng.randint(0, 10, (70, 12)), [0] * 7 + [1, 1, 2]))
+    cases.append(np.array([[0, 1] * 5] * 12).T)
+    cases.append(np.full((9, 6), 2, dtype=np.uint8))
+    cases.append(rng.randint(0, 9, (20, 12)))
+    cases.append(rng.randint(0, 3, (15, 10)) - .5)
+    z = np.round(rng.randn(60, 12) * 3, 1)
+    cases.append(np.where(np.abs(z) < 3, 0, z))
+
+    for data in cases:
+        expected = pci(data, engine='reference')
+        bits = _symbol_bits(data)
+        for engine in _ENGINES:
+            if engine == 'bitparallel' and bits is None:
+                continue
+            got = pci(data, engine=engine)
+            assert got == expected, 'engine %s: %d != %d for shape %s' % (engine, got, expected, data.shape)
+            if bits is not None:
+                packed = PackedRaster.pack(data, bits)
+                assert np.array_equal(packed.unpack(), _as_2d(data))
+                got = pci(packed, engine=engine)
+                assert got == expected, 'engine %s (packed): %d != %d for shape %s' % (engine, got, expected, data.shape)
+    data = cases[-4]
+    packed = PackedRaster.pack(data, np.int64(4))
+    assert packed.count_nonzero() == np.count_nonzero(data)
+    assert pci(packed, engine='bitparallel') == pci(data, engine='reference')
+    assert packed[3:3].shape == (0, data.shape[1]) and packed[:, data.shape[1]:].shape == (data.shape[0], 0)
+    for shape in ((0, 0), (0, 5), (5, 0)):
+        assert PackedRaster.pack(np.zeros(shape), 2).unpack().shape == shape
+
+    # batched, one shared encoding for all trials
+    stack = np.array([1 * (rng.rand(20, 15) < density) for density in densities * 3])
+    expected = [pci(x, engine='reference') for x in stack]
+    for engine in _ENGINES:
+        assert list(pci_many(stack, engine=engine)) == expected
+        assert list(pci_many(list(stack), engine=engine)) == expected
+    mixed = [cases[0], PackedRaster.pack(cases[1]), rng.randint(0, 3, (9, 4))]
+    assert list(pci_many(mixed)) == [pci(x, engine='reference') for x in mixed]
+
+    # downsampled levels against pooling by hand
+    data = 1 * (rng.rand(23, 17) < .3)
+    for row in pci_pyramid(data, (1, 4, 5), (1, 3), pooling='majority'):
+        f, g = row['neuron_factor'], row['time_factor']
+        level = np.array([[np.mean(data[x:x + f, y:y + g]) > .5 for y in range(0, 17, g)] for x in range(0, 23, f)])
+        assert row['shape'] == level.shape and row['pci'] == pci(level, engine='reference')
+
+    # regions and their unions against slicing by hand
+    data = 1 * (rng.rand(30, 12) < .3)
+    regions = {'a': (11, 20), 'b': (21, 35), 'c': (5, 12)}
+    table = pci_regions(data, regions, first_gid=5, unions=[('a', 'b'), ('c', 'a')])
+    expected = [data[0:8], data[6:16], data[16:30], data[6:30], data[0:16]]
+    assert [row['regions'] for row in table] == [('c',), ('a',), ('b',), ('a', 'b'), ('c', 'a')]
+    assert [row['pci'] for row in table] == [pci(x, engine='reference') for x in expected]
+    assert len(pci_regions(PackedRaster.pack(data), regions, first_gid=5)) == 3
+
+    # sliding windows
+    data = 1 * (rng.rand(15, 40) < .3)
+    for width, step in ((1, 1), (3, 2), (4, 1), (10, 3), (40, 5)):
+        expected = [pci(data[:, x:x + width], engine='reference') for x in range(0, 40 - width + 1, step)]
+        assert list(pci_windows(data, width, step)) == expected
+        assert list(pci_windows(PackedRaster.pack(data), width, step, n_jobs=2)) == expected
+
+    # straight from spike events
+    senders = rng.randint(100, 160, 400)
+    times = rng.rand(400) * 50.
+    shape, rows, cols = events_to_cells(senders, times, (110, 149), (5., 45.), 2.)
+    data = np.zeros(shape)
+    data[rows, cols] = 1
+    assert pci_from_events(senders, times, (110, 149), (5., 45.), 2.) == pci(data, engine='reference')
+    # at the simulation resolution, times like 0.3 fill their own bin
+    times = np.round(rng.rand(400) * 4.9, 1)
+    keep = (senders >= 110) & (senders < 150)
+    data = np.zeros((40, 50))
+    data[senders[keep] - 110, np.round(times[keep] * 10).astype(int)] = 1
+    assert pci_from_events(senders, times, (110, 149), (0., 5.), .1) == pci(data, engine='reference')
+
+    # streamed a few columns at a time
+    for data in stack:
+        stream = PCIStream()
+        for start in range(0, data.shape[1], 4):
+            got = stream.push(data[:, start:start + 4])
+            assert got == pci(data[:, :start + 4], engine='reference')
+
+    # early exit on either side of a threshold
+    for data in cases[:12] + list(stack):
+        expected = pci(data, engine='reference')
+        for t in (0, expected - 1, expected, expected + 1, 3 * expected):
+            assert (pci(data, stop_above=t) > t) == (expected > t)
+            assert (pci(data, stop_below=t) < t) == (expected < t)
+
+    # 1D Lempel-Ziv from arrays, bytes and chunk iterators
+    sequences = [1 * (rng.rand(n) < density) for n in (2, 3, 5, 40, 300) for density in densities]
+    sequences += [np.zeros(50, int), np.ones(7, int), np.arange(60) % 3, rng.randint(0, 5, 80), rng.randint(0, 40, 300)]
+    for s in sequences:
+        expected = lz_complexity(s.tolist(), engine='reference')
+        assert lz_complexity(s) == expected
+        assert lz_complexity(bytes(s.astype(np.uint8))) == expected
+        assert lz_complexity(iter(np.array_split(s, 4))) == expected
+    packed = PackedRaster.pack(cases[0])
+    assert lz_complexity(packed) == lz_complexity(cases[0].T.ravel(), engine='reference')
+
+    for engine in _ENGINES:
+        c, stats = pci(cases[0], engine=engine, stats=True)
+        assert c == pci(cases[0], engine='reference') and stats.iterations > 0 and stats.comparisons > 0
+
+    return len(cases) + len(stack) + len(mixed)
+
 
 def main():
     lz = lz_complexity('1001111011000010')
     assert lz == 6
-    print lz
+    print(lz)
+
+    print('Engines agree on %d matrices' % check_engines())
 
+    table = NormalizationTable()
+    data = 1 * (np.random.rand(30,30) > .8)
+    print("Normalized complexity of data : %.3f (%d table entries)" % (pci_normalized(data, table=table), len(table)))
 
+    #data = (1 * (np.random.rand(100,100) > .5)).astype('str')
+    data = 1 * (np.random.rand(30,30) > .5)
 
-#data = (1 * (np.random.rand(100,100) > .5)).astype('str')
-data = 1 * (np.random.rand(30,30) > .5)
+    data_c = pci(data)
+    print("Complexity of data : %d" % data_c)
 
-data_c = pci(data)
-print "Complexity of data : %d" % data_c
+    # Compare to the 1D implementation
 
-# Compare to the 1D implementation
+    data_1d = data.flatten()
 
-data_1d = data.flatten()
+    data_1d_c = pci(data_1d)
+    print("Complexity of 1D data : %d" % data_1d_c)
 
-data_1d_c = pci(data_1d)
-print "Complexity of 1D data : %d" % data_1d_c
+    data_1d_c2 = lz_complexity(data_1d)
+    print("Complexity 2 of 1D data : %d" % data_1d_c2)
 
-data_1d_c2 = lz_complexity(data_1d)
-print "Complexity 2 of 1D data : %d" % data_1d_c2
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+# Resumable PCI jobs over raster files.
+#
+# A job is the PCI of one pickled raster, sliced and downsampled. Results are
+# kept in an SQLite file keyed by the content of the raster file and
+# everything else that goes into the number (slices, downsampling, engine and
+# pci.ENGINE_VERSION), so a relaunch only computes what is missing, whatever
+# the files are called now, and each result is committed as soon as its job
+# finishes.
+#
+# Rasters can be pickled, or in a raster_store file, which workers map and
+# slice instead of loading the whole raster.
+#
+# Missing jobs are scheduled longest first on a cost model fitted to the
+# timings already in the cache, and an optional memory cap keeps several huge
+# rasters from being loaded at the same time. Jobs that only differ in their
+# downsampling factors (the levels of a pyramid) run together, on one read of
+# the raster, and each level is cached on its own.
+
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import resource
+import sqlite3
+import sys
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+import pci
+import pooling
+import raster_store
+
+def job(path, rows=(None, None), cols=(None, None), neuron_factor=1, time_factor=1, pooling='majority', engine='suffix', name=None):
+    """PCI job on the raster pickled in path, or the raster name of the
+    raster store path (see raster_store.load): data[rows[0]:rows[1],
+    cols[0]:cols[1]] pooled in blocks of neuron_factor x time_factor (see
+    pooling.pool, 'any' or 'majority', only for binary rasters) with
+    engine."""
+    j = {'path': path, 'rows': list(rows), 'cols': list(cols),
+         'neuron_factor': neuron_factor, 'time_factor': time_factor,
+         'pooling': pooling, 'engine': engine}
+    if name is not None:
+        # only there when set, so pickle jobs keep their cache keys
+        j['name'] = name
+    return j
+
+# What the cost model knows about a job before running it
+FEATURES = ('file_bytes', 'cells', 'pci_cells', 'active')
+
+def _add_columns(db, table, columns):
+    # columns added after the table was first created
+    have = set(row[1] for row in db.execute('PRAGMA table_info(%s)' % table))
+    for name, kind in columns:
+        if name not in have:
+            db.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, name, kind))
+
+class ResultCache(object):
+    """PCI results in the SQLite file path, one row per job key.
+
+    Besides the complexity every row has the job, its wall time, the peak
+    memory it added to its worker, when it finished and the job's FEATURES.
+    What is known about each raster (hash, shape, active cells) is
+    remembered by (path, size, mtime) so unchanged files are read once.
+    Rasters of a store are hashed on their own bytes only.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha1 TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, job TEXT, pci INTEGER, '
+                        'wall_time REAL, peak_bytes INTEGER, finished TEXT)')
+        _add_columns(self.db, 'files', [('nrows', 'INTEGER'), ('ncols', 'INTEGER'), ('active', 'INTEGER')])
+        _add_columns(self.db, 'results', [(name, 'REAL') for name in FEATURES])
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def file_info(self, path, name=None):
+        """sha1, size, shape and number of active cells of the raster in
+        path (name in it for a raster store), and whether it is in a store."""
+        st = os.stat(path)
+        store = raster_store.is_store(path)
+        ident = path if name is None else '%s::%s' % (path, name)
+        row = self.db.execute('SELECT size, mtime, sha1, nrows, ncols, active FROM files WHERE path = ?', (ident,)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime or row[3] is None:
+            if store:
+                rasters = raster_store.RasterStore(path)
+                raster = rasters.only() if name is None else name
+                data = rasters[raster]
+                sha1 = rasters.digest(raster)
+            else:
+                with open(path, 'rb') as f:
+                    raw = f.read()
+                data = pickle.loads(raw)
+                sha1 = hashlib.sha1(raw).hexdigest()
+                del raw
+            if isinstance(data, pci.PackedRaster):
+                active = data.count_nonzero()
+            else:
+                active = np.count_nonzero(data)
+            row = (st.st_size, st.st_mtime, sha1) + tuple(int(x) for x in pci._as_2d(data).shape) + (int(active),)
+            del data
+            self.db.execute('INSERT OR REPLACE INTO files (path, size, mtime, sha1, nrows, ncols, active) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (ident,) + row)
+            self.db.commit()
+        return {'sha1': row[2], 'size': row[0], 'shape': (row[3], row[4]), 'active': row[5], 'store': store}
+
+    def file_hash(self, path, name=None):
+        return self.file_info(path, name)['sha1']
+
+    def key(self, job):
+        params = dict(job, path=None, file=self.file_hash(job['path'], job.get('name')), version=pci.ENGINE_VERSION)
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def features(self, job):
+        """FEATURES of job, from its file's shape and density."""
+        info = self.file_info(job['path'], job.get('name'))
+        nrows, ncols = info['shape']
+        rows = len(range(nrows)[slice(*job['rows'])])
+        cols = len(range(ncols)[slice(*job['cols'])])
+        cells = float(rows * cols)
+        density = info['active'] / float(max(1, nrows * ncols))
+        # a store is mapped, not loaded: only the slice costs memory
+        return {'file_bytes': 0. if info['store'] else float(info['size']), 'cells': cells,
+                'pci_cells': cells / (job['neuron_factor'] * job['time_factor']),
+                'active': cells * density}
+
+    def get(self, key):
+        """The cached result of key as a dict, or None."""
+        row = self.db.execute('SELECT job, pci, wall_time, peak_bytes, finished FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return {'job': json.loads(row[0]), 'pci': row[1], 'wall_time': row[2], 'peak_bytes': row[3], 'finished': row[4]}
+
+    def put(self, key, result, features=None):
+        features = features or {}
+        self.db.execute('INSERT OR REPLACE INTO results (key, job, pci, wall_time, peak_bytes, finished, %s) '
+                        'VALUES (?, ?, ?, ?, ?, ?, %s)' % (', '.join(FEATURES), ', '.join('?' * len(FEATURES))),
+                        (key, json.dumps(result['job'], sort_keys=True), result['pci'],
+                         result['wall_time'], result['peak_bytes'], result['finished'])
+                        + tuple(features.get(name) for name in FEATURES))
+        self.db.commit()
+
+    def timings(self):
+        """(features, wall times, peak bytes) of the results that have
+        features, as arrays."""
+        rows = self.db.execute('SELECT %s, wall_time, peak_bytes FROM results WHERE cells IS NOT NULL' % ', '.join(FEATURES)).fetchall()
+        rows = np.array(rows, dtype=np.float64).reshape(-1, len(FEATURES) + 2)
+        return rows[:, :len(FEATURES)], rows[:, -2], rows[:, -1]
+
+    def close(self):
+        self.db.close()
+
+class CostModel(object):
+    """Wall time and peak memory of a job, linear in [1, FEATURES].
+
+    Starts from rough defaults (the suffix engine at about a microsecond per
+    cell, the pickle loaded plus a byte per cell) and is refitted by least
+    squares once there are enough timed results, e.g. from a ResultCache.
+    """
+
+    def __init__(self, time_coef=None, memory_coef=None):
+        # coefficients for 1, file_bytes, cells, pci_cells, active
+        self.time_coef = np.array(time_coef if time_coef is not None else [.05, 1e-9, 5e-8, 1.2e-6, 0.])
+        self.memory_coef = np.array(memory_coef if memory_coef is not None else [0., 2., 1., 0., 0.])
+
+    @classmethod
+    def fit(cls, features, wall_time, peak_bytes):
+        model = cls()
+        if len(features) >= 2 * (len(FEATURES) + 1):
+            X = np.column_stack([np.ones(len(features)), features])
+            model.time_coef = np.linalg.lstsq(X, wall_time, rcond=None)[0]
+            model.memory_coef = np.linalg.lstsq(X, peak_bytes, rcond=None)[0]
+        return model
+
+    @classmethod
+    def from_cache(cls, cache):
+        return cls.fit(*cache.timings())
+
+    def _predict(self, coef, features):
+        x = np.concatenate([[1.], [features[name] for name in FEATURES]])
+        return max(float(np.dot(coef, x)), 0.)
+
+    def seconds(self, features):
+        return self._predict(self.time_coef, features)
+
+    def memory(self, features):
+        return self._predict(self.memory_coef, features)
+
+def _max_rss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def load(job):
+    """The raster of job, sliced. Slices of a raster store are views of the
+    mapped file (packed rasters copy the last word of each column when the
+    rows do not end on one)."""
+    if raster_store.is_store(job['path']):
+        data = raster_store.load(job['path'], job.get('name'))
+    else:
+        with open(job['path'], 'rb') as f:
+            data = pickle.load(f)
+    return data[slice(*job['rows']), slice(*job['cols'])]
+
+def _levels_of(job):
+    # what the jobs of one read share: all but the downsampling factors
+    return json.dumps(dict(job, neuron_factor=None, time_factor=None), sort_keys=True)
+
+def _run_levels(keys, jobs):
+    # Runs in a fresh worker (maxtasksperchild=1): the peak resident size it
+    # reaches beyond the one it was forked with is the jobs'. All of jobs are
+    # levels of one raster slice, read once; each level's wall time is its
+    # own plus its share of the read.
+    started = time.time()
+    before = _max_rss()
+    data = load(jobs[0])
+    read = (time.time() - started) / len(jobs)
+    results = []
+    for key, job in zip(keys, jobs):
+        level_started = time.time()
+        level = data
+        if job['neuron_factor'] != 1 or job['time_factor'] != 1:
+            level = pooling.pool(data, job['neuron_factor'], job['time_factor'], reduce=job['pooling'], packed=True)
+        c = pci.pci(level, engine=job['engine'])
+        del level
+        results.append((key, {'job': job, 'pci': int(c), 'wall_time': read + time.time() - level_started,
+                              'peak_bytes': _max_rss() - before, 'finished': time.strftime('%c')}))
+    return results
+
+def run(jobs, cache, n_jobs=1, log=None, memory_cap=None, model=None):
+    """Results of jobs (dicts from job()), in order, from cache or computed.
+
+    Missing jobs are run over n_jobs worker processes, one fresh process per
+    raster slice: the jobs that only differ in neuron_factor and
+    time_factor run in the same process, on one read. Every result is
+    committed to cache as soon as it arrives, so an interrupted run picks
+    up where it stopped. Slices are handed out longest first by model
+    (default CostModel.from_cache(cache), summed over their levels) to
+    whichever worker is free. With memory_cap (bytes), a slice only starts
+    while the predicted memory of the running ones (the largest of their
+    levels) leaves room for it; the longest one that fits goes first, and
+    one bigger than the cap runs alone. log, if given, is
+    called with a line for every job. Each result is a dict with 'job',
+    'pci', 'wall_time', 'peak_bytes', 'finished' and 'cached'.
+    """
+    keys = [cache.key(j) for j in jobs]
+    results = {}
+    todo = {}
+    for key, j in zip(keys, jobs):
+        if key in results or key in todo:
+            continue
+        result = cache.get(key)
+        if result is None:
+            todo[key] = j
+            continue
+        result['cached'] = True
+        results[key] = result
+        if log is not None:
+            log('cached   %s : %d' % (_describe(j), result['pci']))
+
+    if todo:
+        if model is None:
+            model = CostModel.from_cache(cache)
+        features = dict((key, cache.features(j)) for key, j in todo.items())
+        groups = {}
+        for key, j in todo.items():
+            groups.setdefault(_levels_of(j), []).append(key)
+        seconds = dict((group, sum(model.seconds(features[key]) for key in members)) for group, members in groups.items())
+        memory = dict((group, max(model.memory(features[key]) for key in members)) for group, members in groups.items())
+        pending = sorted(groups, key=lambda group: -seconds[group])
+        workers = min(n_jobs if n_jobs > 0 else multiprocessing.cpu_count(), len(groups))
+
+        done = queue.Queue()
+        running = {}
+        pool = multiprocessing.Pool(workers, maxtasksperchild=1)
+        try:
+            while pending or running:
+                used = sum(running.values())
+                for group in list(pending):
+                    if len(running) == workers:
+                        break
+                    if running and memory_cap is not None and used + memory[group] > memory_cap:
+                        continue
+                    pending.remove(group)
+                    running[group] = memory[group]
+                    used += memory[group]
+                    members = groups[group]
+                    pool.apply_async(_run_levels, (members, [todo[key] for key in members]),
+                                     callback=done.put, error_callback=done.put)
+                finished = done.get()
+                if isinstance(finished, BaseException):
+                    raise finished
+                del running[_levels_of(finished[0][1]['job'])]
+                for key, result in finished:
+                    cache.put(key, result, features[key])
+                    result['cached'] = False
+                    results[key] = result
+                    if log is not None:
+                        log('computed %s : %d (%.2f s, %.1f MB, predicted %.2f s, %.1f MB)'
+                            % (_describe(result['job']), result['pci'], result['wall_time'], result['peak_bytes'] / 1e6,
+                               model.seconds(features[key]), model.memory(features[key]) / 1e6))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    return [results[key] for key in keys]
+
+def _describe(job):
+    label = os.path.basename(job['path'])
+    if job.get('name') is not None:
+        label += ':' + job['name']
+    return '%s [%s:%s, %s:%s] / (%d, %d)' % ((label,) + tuple(job['rows']) + tuple(job['cols'])
+                                             + (job['neuron_factor'], job['time_factor']))
@@ -0,0 +1,120 @@
+# Downsampling rasters by pooling blocks of neurons and time bins.
+#
+# pool reduces every block of neuron_factor rows x time_factor columns to one
+# entry in a single vectorised pass: block sums come from a reshape when the
+# factors divide the raster and from np.add.reduceat otherwise, so the last,
+# shorter block of each axis (a ragged tail) is kept and reduced over its own
+# size. Rows can also be laid out as populations of x-y grids, as the
+# simulations build their layers (the plot script's reshape(D, D)), and pooled
+# over x-y patches. Packed rasters are pooled without unpacking when only
+# time is pooled with 'any', and a bounded number of columns at a time
+# otherwise.
+
+import numpy as np
+
+import pci
+
+REDUCTIONS = ('any', 'mean', 'majority', 'count')
+
+# entries unpacked at a time when a packed raster has to be unpacked
+_CHUNK = 1 << 24
+
+def _block_sums(x, axis, factor):
+    # sums of blocks of factor entries along axis, and the block sizes
+    n = x.shape[axis]
+    if factor == 1:
+        return x, np.ones(n, dtype=np.int64)
+    if n % factor == 0:
+        shape = x.shape[:axis] + (n // factor, factor) + x.shape[axis + 1:]
+        return x.reshape(shape).sum(axis=axis + 1), np.full(n // factor, factor, dtype=np.int64)
+    starts = np.arange(0, n, factor)
+    return np.add.reduceat(x, starts, axis=axis), np.minimum(starts + factor, n) - starts
+
+def pool(raster, neuron_factor=1, time_factor=1, reduce='any', layout=None, packed=None):
+    """raster downsampled by pooling blocks of neuron_factor rows x
+    time_factor columns.
+
+    reduce is 'any' (1 if an entry of the block is nonzero), 'majority' (1
+    if more than half are), 'count' (how many are) or 'mean' (the mean of
+    the block's values). Blocks at the end of an axis that the factor does
+    not divide are kept, with fewer entries: majority and mean are taken
+    over the entries they have.
+
+    With layout=(P, H, W) the rows are P populations of H x W grids, one
+    after the other, each in C order (neuron y * W + x), and neuron_factor
+    is a (fy, fx) patch (or f for f x f) pooled within each grid; the
+    pooled rows are laid out the same way, P x ceil(H / fy) x ceil(W / fx).
+
+    raster is a 2D array or a pci.PackedRaster. 'any' and 'majority' give a
+    uint8 0/1 matrix, or a PackedRaster with packed=True (the default for
+    packed input); 'count' gives integers and 'mean' floats.
+    """
+    if reduce not in REDUCTIONS:
+        raise ValueError('unknown reduction %r (expected one of %s)' % (reduce, ', '.join(REDUCTIONS)))
+    if packed is None:
+        packed = isinstance(raster, pci.PackedRaster)
+    if layout is not None:
+        factors = tuple(neuron_factor) if np.ndim(neuron_factor) else (neuron_factor, neuron_factor)
+    else:
+        factors = (neuron_factor,)
+    for factor in factors + (time_factor,):
+        if factor < 1:
+            raise ValueError('pooling factors have to be at least 1, got %r' % (factor,))
+
+    if isinstance(raster, pci.PackedRaster):
+        result = _pool_packed(raster, factors, time_factor, reduce, layout)
+    else:
+        result = _pool(pci._as_2d(np.asarray(raster)), factors, time_factor, reduce, layout)
+    if isinstance(result, pci.PackedRaster):
+        return result if packed else result.unpack()
+    if packed and reduce in ('any', 'majority'):
+        return pci.PackedRaster.pack(result)
+    return result
+
+def _pool(data, factors, time_factor, reduce, layout):
+    nrows, ncols = data.shape
+    if layout is not None:
+        if int(np.prod(layout)) != nrows:
+            raise ValueError('layout %s does not hold %d rows' % (tuple(layout), nrows))
+        data = data.reshape(tuple(layout) + (ncols,))
+        axes = (1, 2)
+    else:
+        axes = (0,)
+
+    if reduce == 'mean':
+        sums = data.astype(np.float64, copy=False)
+    else:
+        # any, majority and count only look at which entries are set
+        dtype = np.int32 if data.size < 2 ** 31 else np.int64
+        sums = (data != 0).astype(dtype)
+    size = np.ones((1,) * sums.ndim, dtype=np.int64)
+    for axis, factor in zip(axes + (sums.ndim - 1,), factors + (time_factor,)):
+        sums, sizes = _block_sums(sums, axis, factor)
+        shape = [1] * sums.ndim
+        shape[axis] = len(sizes)
+        size = size * sizes.reshape(shape)
+
+    if reduce == 'any':
+        result = (sums > 0).astype(np.uint8)
+    elif reduce == 'majority':
+        result = (2 * sums > size).astype(np.uint8)
+    elif reduce == 'mean':
+        result = sums / size
+    else:
+        result = sums
+    return result.reshape(-1, result.shape[-1])
+
+def _pool_packed(raster, factors, time_factor, reduce, layout):
+    if reduce == 'any' and factors == (1,) and layout is None and raster.bits == 1:
+        # OR of the column words of every block: still packed, never unpacked
+        starts = np.arange(0, raster.shape[1], time_factor)
+        if not len(starts):
+            return pci.PackedRaster(raster.words[:0], raster.shape[0], 1)
+        return pci.PackedRaster(np.bitwise_or.reduceat(raster.words, starts, axis=0), raster.shape[0], 1)
+    # whole time blocks of columns at a time
+    step = time_factor * max(1, _CHUNK // max(1, raster.shape[0] * time_factor))
+    parts = [_pool(raster[:, start:start + step].unpack(), factors, time_factor, reduce, layout)
+             for start in range(0, raster.shape[1], step)]
+    if not parts:
+        return _pool(np.zeros((raster.shape[0], 0), dtype=np.uint8), factors, time_factor, reduce, layout)
+    return np.concatenate(parts, axis=1)
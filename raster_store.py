@@ -0,0 +1,166 @@
+# Rasters on disk that PCI workers can slice without loading them.
+#
+# A store is one file: an 8 byte magic, the length of a JSON header, the
+# header (one entry per raster with its name, dtype, shape and where its bytes
+# are) and the rasters themselves, each 64 byte aligned. Dense 2D rasters are
+# written column by column (Fortran order), the order pci parses them in, and
+# PackedRaster keeps its words as they are. RasterStore maps them read-only,
+# so data[:10000, 500:3000] only reads the pages of those columns and a worker
+# holds the slice, not the file.
+#
+# python raster_store.py file.pickle ... writes file.rasters next to each
+# pickled raster, packing the binary ones.
+
+import hashlib
+import json
+import os
+import pickle
+import struct
+import sys
+
+import numpy as np
+
+import pci
+
+MAGIC = b'RASTERS1'
+_ALIGN = 64
+
+def is_store(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def _entry(name, raster):
+    if isinstance(raster, pci.PackedRaster):
+        words = np.ascontiguousarray(raster.words, dtype='<u8')
+        return {'name': name, 'kind': 'packed', 'nrows': raster.shape[0], 'bits': raster.bits,
+                'dtype': words.dtype.str, 'shape': list(words.shape), 'order': 'C'}, words
+    data = np.asarray(raster)
+    if data.ndim == 2:
+        # columns contiguous: written as the C order transpose
+        return {'name': name, 'kind': 'dense', 'dtype': data.dtype.str, 'shape': list(data.shape),
+                'order': 'F'}, np.ascontiguousarray(data.T)
+    return {'name': name, 'kind': 'dense', 'dtype': data.dtype.str, 'shape': list(data.shape),
+            'order': 'C'}, np.ascontiguousarray(data)
+
+def write(path, rasters, meta=None):
+    """Write rasters (a dict or (name, raster) pairs of arrays and
+    PackedRaster) to the store path, with meta (anything JSON can hold) in
+    its header. The file is written aside and renamed, so readers never see
+    half a store."""
+    items = sorted(rasters.items()) if isinstance(rasters, dict) else list(rasters)
+    entries = []
+    blobs = []
+    for name, raster in items:
+        entry, blob = _entry(name, raster)
+        entry['nbytes'] = blob.nbytes
+        entries.append(entry)
+        blobs.append(blob)
+
+    # offsets depend on the header length and the header holds the offsets:
+    # grow the room for the header until it fits
+    room = _ALIGN
+    while True:
+        offset = len(MAGIC) + 8 + room
+        for entry in entries:
+            entry['offset'] = offset
+            offset += -(-entry['nbytes'] // _ALIGN) * _ALIGN
+        header = json.dumps({'rasters': entries, 'meta': meta}, sort_keys=True).encode('utf-8')
+        if len(header) <= room:
+            break
+        room = -(-len(header) // _ALIGN) * _ALIGN
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', room) + header.ljust(room))
+        for entry, blob in zip(entries, blobs):
+            f.seek(entry['offset'])
+            blob.tofile(f)
+        f.truncate(offset)
+    os.rename(tmp, path)
+
+class RasterStore(object):
+    """The rasters in the store path, mapped read-only on access.
+
+    store[name] is a numpy memmap (2D ones Fortran ordered) or a PackedRaster
+    over memmapped words; slicing either reads only what the slice covers.
+    names lists the rasters in file order and meta is what write was given.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a raster store' % path)
+            room, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(room).decode('utf-8'))
+        self.entries = dict((entry['name'], entry) for entry in header['rasters'])
+        self.names = [entry['name'] for entry in header['rasters']]
+        self.meta = header['meta']
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __getitem__(self, name):
+        entry = self.entries[name]
+        shape = tuple(entry['shape'])
+        if entry['order'] == 'F':
+            shape = shape[::-1]
+        if not entry['nbytes']:
+            # np.memmap cannot map 0 bytes
+            data = np.zeros(shape, dtype=entry['dtype'])
+        else:
+            data = np.memmap(self.path, dtype=entry['dtype'], mode='r', offset=entry['offset'], shape=shape)
+        if entry['order'] == 'F':
+            data = data.T
+        if entry['kind'] == 'packed':
+            return pci.PackedRaster(data, entry['nrows'], entry['bits'])
+        return data
+
+    def only(self):
+        """Name of the raster of a store that holds a single one."""
+        if len(self.names) != 1:
+            raise ValueError('%s holds %d rasters, pick one of %s' % (self.path, len(self.names), ', '.join(self.names)))
+        return self.names[0]
+
+    def digest(self, name, blocksize=1 << 24):
+        """sha1 of the raster name: its header entry, less where it is, and
+        its bytes. Unchanged rasters keep their digest when the rest of the
+        store is rewritten."""
+        entry = dict(self.entries[name])
+        offset = entry.pop('offset')
+        remaining = entry['nbytes']
+        digest = hashlib.sha1(json.dumps(entry, sort_keys=True).encode('utf-8'))
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while remaining:
+                block = f.read(min(blocksize, remaining))
+                if not block:
+                    raise ValueError('%s is truncated' % self.path)
+                digest.update(block)
+                remaining -= len(block)
+        return digest.hexdigest()
+
+def load(path, name=None):
+    """The raster name of the store path, mapped. name can be left out when
+    the store holds a single raster."""
+    store = RasterStore(path)
+    return store[store.only() if name is None else name]
+
+def convert(path, output=None):
+    """Write the raster pickled in path to a store (default: path with a
+    .rasters extension) under the name 'raster', packed if it is binary."""
+    if output is None:
+        output = os.path.splitext(path)[0] + '.rasters'
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    if not isinstance(data, pci.PackedRaster) and np.all((data == 0) | (data == 1)):
+        data = pci.PackedRaster.pack(data)
+    write(output, {'raster': data}, meta={'source': os.path.basename(path)})
+    return output
+
+if __name__ == '__main__':
+    for next_file in sys.argv[1:]:
+        print('%s -> %s' % (next_file, convert(next_file)))
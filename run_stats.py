@@ -0,0 +1,83 @@
+# Statistics across runs of a simulation, one raster at a time.
+#
+# Holding every run to take np.mean / np.std / ttest_1samp over them costs
+# runs x raster; RunStatistics keeps a running mean, sum of squared
+# deviations (Welford's online algorithm) and OR instead, so memory stays at
+# a few rasters however many runs are added.
+
+import warnings
+
+import numpy as np
+
+class RunStatistics(object):
+    """Mean, variance, t statistic and OR over runs of rasters of shape,
+    added one at a time with add.
+
+    mean, std(ddof), ttest(popmean) and any match np.mean, np.std,
+    scipy.stats.ttest_1samp(...).statistic and np.any over the stacked runs
+    (axis 0), up to rounding.
+    """
+
+    def __init__(self, shape):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.any = np.zeros(shape, dtype=bool)
+        # sum of squared deviations from the mean
+        self._m2 = np.zeros(shape)
+
+    def add(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if x.shape != self.mean.shape:
+            raise ValueError('run of shape %s, expected %s' % (x.shape, self.mean.shape))
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        # delta * (x - new mean), reusing delta
+        delta *= x - self.mean
+        self._m2 += delta
+        self.any |= x != 0
+
+    def var(self, ddof=0):
+        return self._m2 / (self.n - ddof)
+
+    def std(self, ddof=0):
+        return np.sqrt(self.var(ddof))
+
+    def ttest(self, popmean):
+        """One sample t statistic of every entry against popmean; inf or nan
+        where all runs agree, like scipy."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (self.mean - popmean) / np.sqrt(self.var(1) / self.n)
+
+def check_statistics(seed=0):
+    """Compare RunStatistics against np.mean, np.std, ttest_1samp and np.any
+    over random stacks of runs, with entries equal in every run (all 0, all
+    1, all at popmean) and a single run among them."""
+    try:
+        from scipy import stats
+    except ImportError:
+        stats = None
+    rng = np.random.RandomState(seed)
+    stacks = [1. * (rng.rand(n, 12, 9) < density) for n in (1, 2, 5, 17) for density in (.1, .5)]
+    stacks += [rng.randn(6, 4, 7) * 3 + 1, np.round(rng.rand(4, 10, 3), 1)]
+    for stack in stacks:
+        # entries that are the same in every run
+        stack[:, 0, :3] = (0, 1, .5)
+        s = RunStatistics(stack.shape[1:])
+        for x in stack:
+            s.add(x)
+        assert s.n == len(stack)
+        assert np.allclose(s.mean, np.mean(stack, axis=0))
+        assert np.allclose(s.std(), np.std(stack, axis=0))
+        assert np.array_equal(s.std()[0, :3], np.zeros(3))
+        assert np.array_equal(s.any, np.any(stack, axis=0))
+        if stats is not None:
+            # scipy warns about the entries that are the same in every run
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                expected = stats.ttest_1samp(stack, .5, axis=0).statistic
+            assert np.allclose(s.ttest(.5), expected, equal_nan=True)
+    return len(stacks)
+
+if __name__ == '__main__':
+    print('Run statistics agree on %d stacks' % check_statistics())
@@ -1 +1,7 @@
-N_vp = 16
\ No newline at end of file
+N_vp = 16
+# Follow the PCI of one detector (e.g. 'Vp_v L4pyr') while nsdm_htmodel.py
+# simulates in sim_interval steps, and stop once it goes above
+# live_pci_stop_above. None simulates in one go. Following the PCI imports
+# pci, which needs Python 3 and NumPy 1.17 or later.
+live_pci_detector = None
+live_pci_stop_above = None
@@ -0,0 +1,149 @@
+# Rendering compiled rasters as screens, a frame per time bin.
+#
+# The rows of a compiled raster are P populations of D x D grids, one after
+# the other (as the simulations build their layers), so an N x T raster is,
+# with a single reshape, T frames of P screens. Frames are colormapped in one
+# vectorised pass and written straight to PNG files (spread over processes)
+# or to one GIF, with no matplotlib figure per frame; the plots that need
+# axes and a colorbar reuse one figure (ImageFigure), updating its image.
+
+import multiprocessing
+
+import numpy as np
+
+import matplotlib
+import matplotlib.colors
+import matplotlib.figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+def grid_size(nrows, populations=1):
+    """D such that nrows are populations D x D grids, or None."""
+    if nrows % populations:
+        return None
+    side = int(round(np.sqrt(nrows // populations)))
+    return side if side * side * populations == nrows else None
+
+def screens(raster, populations=1):
+    """The N x T raster as T x populations x D x D screens, a view when
+    raster is contiguous."""
+    raster = np.asarray(raster)
+    side = grid_size(raster.shape[0], populations)
+    if side is None:
+        raise ValueError('%d rows are not %d square grids' % (raster.shape[0], populations))
+    return raster.reshape(populations, side, side, raster.shape[1]).transpose(3, 0, 1, 2)
+
+def _cmap(cmap):
+    if cmap is None or isinstance(cmap, str):
+        return matplotlib.colormaps[cmap or matplotlib.rcParams['image.cmap']]
+    return cmap
+
+def _limits(data, vmin, vmax):
+    # vmin and vmax, the range of the finite (unmasked) data where None
+    if vmin is None or vmax is None:
+        finite = np.ma.masked_invalid(np.ma.asarray(data, dtype=np.float64)).compressed()
+        if vmin is None:
+            vmin = finite.min() if finite.size else 0.
+        if vmax is None:
+            vmax = finite.max() if finite.size else 1.
+    return vmin, vmax
+
+def _zoom(frames, zoom):
+    # nearest neighbour upsampling of the last two axes
+    if zoom == 1:
+        return frames
+    return np.repeat(np.repeat(frames, zoom, axis=-2), zoom, axis=-1)
+
+def colormap(frames, cmap=None, vmin=None, vmax=None, zoom=1):
+    """uint8 RGBA of frames (any shape, the last two axes an image) mapped
+    through cmap between vmin and vmax (the data's range by default), NaN
+    in the colormap's bad color; each entry a zoom x zoom block."""
+    frames = np.asarray(frames, dtype=np.float64)
+    norm = matplotlib.colors.Normalize(*_limits(frames, vmin, vmax))
+    return _cmap(cmap)(norm(_zoom(frames, zoom)), bytes=True)
+
+def _write_pngs(job):
+    import matplotlib.image
+    frames, paths, cmap, vmin, vmax, zoom = job
+    for rgba, path in zip(colormap(frames, cmap, vmin, vmax, zoom), paths):
+        matplotlib.image.imsave(path, rgba)
+
+def write_pngs(frames, paths, cmap=None, vmin=None, vmax=None, zoom=1, n_jobs=1, batch=64):
+    """Write each of frames (n x H x W) as a colormapped PNG image to the
+    matching path. vmin and vmax default to the range of all the frames, so
+    they share one scale. Batches of frames are colormapped and written by
+    n_jobs processes."""
+    frames = np.asarray(frames)
+    paths = list(paths)
+    if len(paths) != len(frames):
+        raise ValueError('%d paths for %d frames' % (len(paths), len(frames)))
+    vmin, vmax = _limits(frames, vmin, vmax)
+    jobs = [(frames[i:i + batch], paths[i:i + batch], _cmap(cmap), vmin, vmax, zoom)
+            for i in range(0, len(frames), batch)]
+    if n_jobs == 1 or len(jobs) < 2:
+        for job in jobs:
+            _write_pngs(job)
+        return
+    pool = multiprocessing.Pool(min(n_jobs, len(jobs)))
+    try:
+        pool.map(_write_pngs, jobs)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def write_gif(frames, path, cmap=None, vmin=None, vmax=None, zoom=1, fps=15):
+    """Write frames (n x H x W) as an animated GIF looping at fps. Frames
+    are indexed straight into a palette of 255 colors of cmap (and its bad
+    color for NaN), so nothing is quantized per frame."""
+    from PIL import Image
+    cmap = _cmap(cmap)
+    frames = np.asarray(frames, dtype=np.float64)
+    norm = matplotlib.colors.Normalize(*_limits(frames, vmin, vmax))
+    scaled = np.ma.filled(norm(_zoom(frames, zoom)), np.nan)
+    levels = 255
+    index = np.clip(np.floor(np.nan_to_num(scaled) * levels), 0, levels - 1).astype(np.uint8)
+    index[np.isnan(scaled)] = levels
+    palette = np.concatenate([cmap((np.arange(levels) + .5) / levels, bytes=True),
+                              cmap(np.array([np.nan]), bytes=True)])[:, :3].ravel().tolist()
+    images = []
+    for frame in index:
+        # putpalette makes the 8 bit image a palette one
+        image = Image.fromarray(frame)
+        image.putpalette(palette)
+        images.append(image)
+    if not images:
+        raise ValueError('no frames to write to %s' % path)
+    images[0].save(path, save_all=True, append_images=images[1:], duration=int(round(1000. / fps)), loop=0)
+
+class ImageFigure(object):
+    """One figure holding an image (and its colorbar), reused for every
+    image saved with it: save swaps the data and color limits of the image
+    artist and redraws, instead of building a new figure each time.
+
+    cmap, vmin and vmax are the defaults of save, None limits meaning the
+    range of each image; imshow takes further matplotlib imshow arguments.
+    """
+
+    def __init__(self, cmap=None, vmin=None, vmax=None, colorbar=True, **imshow):
+        self.figure = matplotlib.figure.Figure()
+        FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot(111)
+        self.cmap = cmap
+        self.vmin = vmin
+        self.vmax = vmax
+        self.colorbar = colorbar
+        self.imshow = dict(dict(interpolation='nearest', aspect='auto'), **imshow)
+        self.image = None
+
+    def save(self, data, path, vmin=None, vmax=None):
+        """Draw data (2D, may be masked) and save the figure to path."""
+        if self.image is None:
+            self.image = self.axes.imshow(data, cmap=_cmap(self.cmap), **self.imshow)
+            if self.colorbar:
+                self.figure.colorbar(self.image, ax=self.axes)
+        else:
+            self.image.set_data(data)
+            rows, cols = np.shape(data)[:2]
+            self.image.set_extent((-.5, cols - .5, rows - .5, -.5))
+        self.image.set_clim(*_limits(data, self.vmin if vmin is None else vmin, self.vmax if vmax is None else vmax))
+        self.figure.savefig(path)
@@ -0,0 +1,116 @@
+# Spike rasters from spike detector events.
+#
+# NEST spike detectors give (senders, times) pairs. bin_spikes turns them into
+# a neuron x time-bin raster in one scatter: rows are fixed by an explicit GID
+# range and columns by an explicit time window and bin width, so the raster no
+# longer depends on which neuron fired first or on the first spike time, and
+# it can come out as spike counts, 0/1 or packed bits for pci.
+
+import glob
+import os
+
+import numpy as np
+
+import loader
+import pci
+
+OUTPUTS = ('counts', 'binary', 'packed')
+
+def n_bins(window, bin_width):
+    """Number of bin_width bins covering [window[0], window[1])."""
+    return int(np.ceil(np.round((window[1] - window[0]) / float(bin_width), 9)))
+
+def bin_index(times, window, bin_width=1.):
+    """Bin of each of times (ms) in bin_width bins from window[0], as in
+    bin_spikes (negative before the window)."""
+    times = np.asarray(times, dtype=np.float64)
+    # times are multiples of the simulation resolution: round away the float
+    # error before flooring, or 0.3 / 0.1 lands in bin 2
+    return np.floor(np.round((times - window[0]) / bin_width, 9)).astype(np.int64)
+
+def spike_cells(senders, times, gids, window, bin_width=1., columns=None):
+    """The raster shape and the row and column of every spike binned as in
+    bin_spikes (a cell repeats for each of its spikes), leaving out spikes of
+    other GIDs or outside the window."""
+    if bin_width <= 0:
+        raise ValueError('bin_width has to be positive, got %r' % (bin_width,))
+    first, last = int(gids[0]), int(gids[1])
+    nrows = max(last - first + 1, 0)
+    ncols = max(n_bins(window, bin_width), 0)
+
+    senders = np.asarray(senders, dtype=np.int64).ravel()
+    times = np.asarray(times, dtype=np.float64).ravel()
+    if senders.shape != times.shape:
+        raise ValueError('%d senders for %d times' % (len(senders), len(times)))
+    cols = bin_index(times, window, bin_width)
+    keep = (senders >= first) & (senders <= last) & (cols >= 0) & (cols < ncols) & (times < window[1])
+    if columns is not None:
+        start, stop = max(columns[0], 0), min(columns[1], ncols)
+        keep &= (cols >= start) & (cols < stop)
+        ncols = max(stop - start, 0)
+        cols -= start
+    return (nrows, ncols), senders[keep] - first, cols[keep]
+
+def bin_spikes(senders, times, gids, window, bin_width=1., output='binary', columns=None):
+    """Raster of the spikes senders[i] fired at times[i] (ms).
+
+    Row g - gids[0] is GID g, for GIDs gids[0] to gids[1] inclusive (the
+    (first GID, last GID) of gids.pickle); column b holds the spikes in
+    [window[0] + b * bin_width, window[0] + (b + 1) * bin_width), the last
+    one cut at window[1]. Spikes of other GIDs or outside the window are
+    left out. output is 'counts' (int64 spikes per bin), 'binary' (uint8,
+    1 where there is at least one) or 'packed' (a binary pci.PackedRaster,
+    built without the dense matrix).
+
+    columns=(start, stop) only keeps those columns of the window (a tile of
+    it), binned exactly as in the whole raster.
+    """
+    if output not in OUTPUTS:
+        raise ValueError('unknown output %r (expected one of %s)' % (output, ', '.join(OUTPUTS)))
+    (nrows, ncols), rows, cols = spike_cells(senders, times, gids, window, bin_width, columns)
+
+    if output == 'counts':
+        counts = np.bincount(rows * ncols + cols, minlength=nrows * ncols)
+        return counts.reshape(nrows, ncols)
+    if output == 'binary':
+        raster = np.zeros((nrows, ncols), dtype=np.uint8)
+        raster[rows, cols] = 1
+        return raster
+    # one bit per (row, column), column words as in PackedRaster.pack
+    nwords = -(-nrows // 64)
+    words = np.zeros((ncols, nwords), dtype='<u8')
+    np.bitwise_or.at(words.reshape(-1), cols * nwords + rows // 64,
+                     np.left_shift(np.uint64(1), (rows % 64).astype(np.uint64)))
+    return pci.PackedRaster(words, nrows, 1)
+
+def bin_folder(folder, window, bin_width=1., output='binary', gids=None, pattern='spikes_*.pickle', ahead=4):
+    """Bin every spike detector file (pattern) of the simulation folder in
+    one pass: their events are read (loader.prefetch, ahead files at a
+    time) and binned together into one raster.
+
+    gids is a (first GID, last GID) range or a population -> range dict,
+    by default the folder's gids.pickle; with a dict the raster spans all of
+    its ranges, so the populations are row ranges of it (see
+    pci.pci_regions). Returns a dict with 'raster', 'first_gid' (the GID of
+    row 0), 'regions' (the dict, or None), 'files', 'window' and
+    'bin_width'.
+    """
+    if gids is None:
+        gids = loader.load(os.path.join(folder, 'gids.pickle'))
+    regions = None
+    if isinstance(gids, dict):
+        regions = gids
+        gids = (min(r[0] for r in regions.values()), max(r[1] for r in regions.values()))
+
+    files = sorted(glob.glob(os.path.join(folder, pattern)))
+    senders = []
+    times = []
+    for _, data in loader.prefetch(files, ahead=ahead):
+        senders.append(np.asarray(data['senders'], dtype=np.int64))
+        times.append(np.asarray(data['times'], dtype=np.float64))
+    senders = np.concatenate(senders) if senders else np.zeros(0, dtype=np.int64)
+    times = np.concatenate(times) if times else np.zeros(0)
+
+    return {'raster': bin_spikes(senders, times, gids, window, bin_width, output),
+            'first_gid': int(gids[0]), 'regions': regions, 'files': files,
+            'window': tuple(window), 'bin_width': bin_width}
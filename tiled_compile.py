@@ -0,0 +1,135 @@
+# Cross-run statistics of many simulations in bounded memory.
+#
+# The statistics of the compile ('mean', 'std', 'z', 't', 'any' over runs)
+# are per entry of the neuron x time plane of every file, so the plane can be
+# cut in tiles computed independently: a tile streams the same file of every
+# run through a run_stats.RunStatistics of its own size, binning only its
+# neurons and bins, and writes its finished block to a chunked_store. Tiles
+# are sized so that n_jobs of them fit in the memory budget and are spread
+# over n_jobs processes; each run's file is read once per tile.
+
+import multiprocessing
+import time
+
+import numpy as np
+
+import chunked_store
+import loader
+import pooling
+import spike_raster
+from run_stats import RunStatistics
+
+# bytes per entry of a tile while it is accumulated: the float64 running mean
+# and squared deviations, the OR, and add's float64 temporaries
+BYTES_PER_ENTRY = 48
+
+def tile_shape(nrows, ncols, memory_budget=None, n_jobs=1):
+    """Rows x columns of tiles such that n_jobs of them take at most
+    memory_budget bytes: whole rows and as many columns as fit, or fewer
+    rows of one column. None is a single tile."""
+    if memory_budget is None:
+        return max(nrows, 1), max(ncols, 1)
+    entries = max(1, int(memory_budget) // (max(n_jobs, 1) * BYTES_PER_ENTRY))
+    if entries >= nrows:
+        return max(nrows, 1), max(1, min(ncols, entries // max(nrows, 1)))
+    return entries, 1
+
+def compile_runs(runs, gids, window, bin_width, path, memory_budget=None, n_jobs=1, downsample_neuron=0,
+                 meta=None, log=None, ahead=2):
+    """Statistics across runs written to the chunked store path.
+
+    runs lists the files of every run (simulation folder), the same
+    population at the same position in each; gids has the (first GID, last
+    GID) of each position, all of the same size. Every file is binned with
+    spike_raster.bin_spikes(..., window, bin_width) and pooled over blocks of
+    downsample_neuron neurons with 'any' when that is above 1.
+
+    The store has datasets 'mean', 'std', 't' (one sample t statistic
+    against .5), 'any' (uint8) and 'z' (mean / std, with the smallest
+    nonzero std of all entries where the std is 0), each positions x neurons
+    x bins, chunked by tile, and meta with 'N' (number of runs) added.
+    memory_budget (bytes, None for one tile per position) bounds the tiles
+    being accumulated by the n_jobs processes (-1 for one per core) at
+    once; the spike events of the ahead files each process reads in
+    advance come on top. log, if given, is called with a line per finished
+    tile.
+    """
+    n_jobs = n_jobs if n_jobs > 0 else multiprocessing.cpu_count()
+    factor = max(int(downsample_neuron), 1)
+    raw_rows = set(int(last) - int(first) + 1 for first, last in gids)
+    if len(raw_rows) != 1:
+        raise ValueError('populations of different sizes: %s' % sorted(raw_rows))
+    raw_rows = raw_rows.pop()
+    nrows = -(-raw_rows // factor)
+    ncols = spike_raster.n_bins(window, bin_width)
+    tile = tile_shape(nrows, ncols, memory_budget, n_jobs)
+    shape = (len(gids), nrows, ncols)
+    chunks = (1,) + tile
+
+    meta = dict(meta or {}, N=len(runs))
+    writer = chunked_store.StoreWriter(path, dict((name, (shape, dtype, chunks)) for name, dtype in
+                                                  [('mean', np.float64), ('std', np.float64), ('z', np.float64),
+                                                   ('t', np.float64), ('any', np.uint8)]), meta)
+    tiles = [(position, r0, min(r0 + tile[0], nrows), c0, min(c0 + tile[1], ncols))
+             for position in range(len(gids))
+             for r0 in range(0, nrows, tile[0])
+             for c0 in range(0, ncols, tile[1])]
+    jobs = [(writer, [files[t[0]] for files in runs], gids[t[0]], window, bin_width, factor, raw_rows, t, ahead)
+            for t in tiles]
+
+    pool = multiprocessing.Pool(n_jobs) if n_jobs != 1 else None
+    try:
+        mapped = pool.imap_unordered if pool is not None else map
+        # smallest nonzero std over all tiles, for z
+        min_std = np.inf
+        for done, (t, tile_min_std, elapsed) in enumerate(mapped(_accumulate_tile, jobs), 1):
+            min_std = min(min_std, tile_min_std)
+            if log is not None:
+                log('tile %d/%d: file %d, neurons %d:%d, bins %d:%d, %d runs (%.2f s)'
+                    % ((done, len(tiles)) + t + (len(runs), elapsed)))
+        for _ in mapped(_z_tile, [(writer, t, min_std) for t in tiles]):
+            pass
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    writer.close()
+    if log is not None:
+        log('wrote %s' % path)
+    return chunked_store.ChunkedStore(path)
+
+def _accumulate_tile(job):
+    writer, files, gids, window, bin_width, factor, raw_rows, t, ahead = job
+    started = time.time()
+    position, r0, r1, c0, c1 = t
+    first = int(gids[0]) + r0 * factor
+    last = int(gids[0]) + min(r1 * factor, raw_rows) - 1
+    stats = RunStatistics((r1 - r0, c1 - c0))
+    for _, data in loader.prefetch(files, ahead=ahead):
+        x = spike_raster.bin_spikes(data['senders'], data['times'], (first, last), window, bin_width, columns=(c0, c1))
+        del data
+        if factor > 1:
+            x = pooling.pool(x, factor, reduce='any')
+        stats.add(x)
+
+    start = (position, r0, c0)
+    std = stats.std()
+    writer.write('mean', start, stats.mean[None])
+    writer.write('std', start, std[None])
+    writer.write('t', start, stats.ttest(.5)[None])
+    writer.write('any', start, stats.any[None])
+    positive = std[std > 0]
+    return t, (positive.min() if positive.size else np.inf), time.time() - started
+
+def _z_tile(job):
+    writer, t, min_std = job
+    position, r0, r1, c0, c1 = t
+    key = (position, slice(r0, r1), slice(c0, c1))
+    mean = writer.dataset('mean')[key]
+    std = writer.dataset('std')[key]
+    if np.isfinite(min_std):
+        std = np.where(std == 0, min_std, std)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        writer.write('z', (position, r0, c0), (mean / std)[None])